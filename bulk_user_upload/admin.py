@@ -1,17 +1,25 @@
-import pandas
 import logging
 from django.contrib import admin, messages
 from django.contrib.admin.options import IS_POPUP_VAR
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.decorators import permission_required
+from django.core.paginator import Paginator
 from django.db import transaction
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseRedirect
 from django.urls import path, reverse
+from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.views import generic
 
+from bulk_user_upload import tracing
+from bulk_user_upload.jobs import build_users_creator, create_uploaded_users
+from bulk_user_upload.models import UploadJob
+from bulk_user_upload.reports import IssueReport, summarize_issues
 from bulk_user_upload.settings import bulk_user_upload_settings
 
-from bulk_user_upload.utils import FieldValidator
+from bulk_user_upload.utils import (
+    FieldValidator, email_result_tuple, get_email_sender, send_account_emails
+)
 
 logger = logging.getLogger(__file__)
 
@@ -27,6 +35,16 @@ class BulkUploadUserAdmin(UserAdmin):
                 self.admin_site.admin_view(BulkUploadUsers.as_view()),
                 name="bulk-upload-users",
             ),
+            path(
+                "admin/bulk_upload_users/reports/<str:report_id>.<str:file_format>",
+                self.admin_site.admin_view(IssueReportDownload.as_view()),
+                name="bulk-upload-report-download",
+            ),
+            path(
+                "admin/bulk_upload_users/jobs/<int:pk>/",
+                self.admin_site.admin_view(UploadJobStatus.as_view()),
+                name="bulk-upload-job",
+            ),
         ]
         return my_urls + urls
 
@@ -44,6 +62,9 @@ class BulkUploadUsers(generic.FormView):
     email_sender_cls = bulk_user_upload_settings.EMAIL_SENDER
     username_field = bulk_user_upload_settings.USERNAME_FIELD
     email_field = bulk_user_upload_settings.EMAIL_FIELD
+    process_in_background = bulk_user_upload_settings.ASYNC_UPLOADS
+    tracer = None
+    report_page_size = 100
 
     @property
     def user_field_validators(self):
@@ -51,11 +72,17 @@ class BulkUploadUsers(generic.FormView):
 
     @property
     def users_creator(self):
-        return self.users_creator_cls(username_field=self.username_field, users_preprocessor_cls=self.users_preprocessor_cls)
+        return build_users_creator(self.users_creator_cls, self.username_field, self.users_preprocessor_cls)
 
     @property
     def email_sender(self):
-        return self.email_sender_cls(username_field=self.username_field, email_field=self.email_field)
+        return get_email_sender(
+            self.email_sender_cls,
+            username_field=self.username_field,
+            email_field=self.email_field,
+            concurrency=bulk_user_upload_settings.EMAIL_CONCURRENCY,
+            rate_limit=bulk_user_upload_settings.EMAIL_RATE_LIMIT,
+        )
 
     @staticmethod
     def get_email_recipient_name(user):
@@ -65,6 +92,8 @@ class BulkUploadUsers(generic.FormView):
         permission_required(["users.add_user", "users.change_user"], raise_exception=True),
     )
     def get(self, request, *args, **kwargs):
+        if "report" in request.GET:
+            return self.render_report(request.GET["report"])
         return super().get(request, *args, **kwargs)
 
     @method_decorator(
@@ -75,52 +104,181 @@ class BulkUploadUsers(generic.FormView):
         Handle POST requests: instantiate a form instance with the passed
         POST variables and then check if it's valid.
         """
+        tracer_cls = bulk_user_upload_settings.TRACER
+        self.tracer = tracer_cls() if tracer_cls else None
+        if self.tracer is None:
+            return self.process_upload(request)
+        with tracing.activate(self.tracer):
+            return self.process_upload(request)
+
+    def process_upload(self, request):
         form = self.get_form()
-        if form.is_valid("_validate" in request.POST):
+        validate_only = "_validate" in request.POST
+        if form.is_valid(validate_only, defer_processing=self.process_in_background and not validate_only):
             if form.validate_only:
-                if "warnings" not in form.uploaded_data:
+                if not form.count_issues("warnings"):
                     messages.add_message(request, messages.SUCCESS, "Uploaded CSV passed all checks.")
                 return self.form_invalid(form)
             return self.form_valid(form)
         else:
             return self.form_invalid(form)
 
+    def send_emails(self, form, created):
+        """Sends account creation emails to the created users; returns the email result, or None if none were sent."""
+        if not form.cleaned_data["send_emails"] or not created:
+            return None
+        try:
+            return send_account_emails(
+                self.email_sender,
+                self.email_template_name,
+                self.request.build_absolute_uri('/'),
+                self.email_sender_address,
+                self.email_subject,
+                self.get_email_recipient_name,
+                created
+            )
+        except Exception as e:
+            logger.exception(f"Something went wrong while sending account creation emails: {e}", exc_info=e)
+            return email_result_tuple(0, len(created), 0)
+
+    def report_creation(self, created, updated):
+        messages.add_message(self.request, messages.SUCCESS, f"{len(created)} New users created.")
+        if updated:
+            messages.add_message(self.request, messages.SUCCESS, f"{len(updated)} Existing users updated.")
+
+    def report_emails(self, email_results):
+        email_results = [result for result in email_results if result]
+        if not email_results:
+            return
+        sent = sum(result.sent for result in email_results)
+        failed = sum(result.failed for result in email_results)
+        seconds = sum(result.seconds for result in email_results)
+        rate = f" ({sent / seconds:.1f} per second)" if sent and seconds else ""
+        message = f"{sent} account creation emails sent{rate}."
+        if failed:
+            message += f" {failed} emails could not be sent; see the logs for details."
+        messages.add_message(self.request, messages.WARNING if failed else messages.SUCCESS, message)
+
     def form_valid(self, form):
+        previous_run = form.get_previous_run()
+        if previous_run is not None:
+            return self.form_duplicate(form, previous_run)
+        if form.defer_processing:
+            return self.form_valid_in_background(form)
+        users_creator = self.users_creator
+        created = []
+        email_results = []
         try:
-            with transaction.atomic():
-                created, skipped = self.users_creator(form.uploaded_data)
-                messages.add_message(self.request, messages.SUCCESS, f"{len(created)} New users created.")
-                if form.cleaned_data["send_emails"]:
-                    self.email_sender(
-                        self.email_template_name,
-                        self.request.build_absolute_uri('/'),
-                        self.email_sender_address,
-                        self.email_subject,
-                        self.get_email_recipient_name,
-                        created
-                    )
-                return self.form_invalid(form, created)
-        except (Exception, BaseException) as e:  # noqa
-            message = f"Something went wrong while creating users; some emails may have been sent in error: {e}"
+            result = create_uploaded_users(
+                form,
+                users_creator,
+                form.content_hash,
+                email=lambda new_users: email_results.append(self.send_emails(form, new_users)),
+                on_batch=lambda batch_result: created.extend(batch_result.created),
+            )
+        except Exception as e:
+            if users_creator.batch_size:
+                # the batches committed before the failure are kept
+                message = (
+                    f"Something went wrong while creating users; {len(created)} users in completed batches were "
+                    f"created, resubmit the same file to resume after them: {e}"
+                )
+            else:
+                message = f"Something went wrong while creating users; no users were created: {e}"
             logger.exception(message, exc_info=e)
             messages.add_message(self.request, messages.ERROR, message)
+            self.report_emails(email_results)
+            return self.form_invalid(form)
+        self.report_creation(result.created, result.updated)
+        self.report_emails(email_results)
         return self.form_invalid(form)
 
-    def form_invalid(self, form, created=None):
+    def form_duplicate(self, form, previous_run):
+        """Refuses to process an upload identical to one that was recently processed."""
+        finished_at = timezone.localtime(previous_run["finished_at"])
+        messages.add_message(
+            self.request,
+            messages.WARNING,
+            f"This file was already uploaded at {finished_at:%Y-%m-%d %H:%M}, when {previous_run['created']} users were "
+            f"created and {previous_run['updated']} updated; it was not processed again. Check \"Process again\" to "
+            "process it anyway.",
+        )
+        return self.form_invalid(form)
+
+    def form_valid_in_background(self, form):
+        """Stores the upload as an UploadJob to be processed in the background and redirects to its status page."""
+        job = UploadJob.objects.create(
+            csv_file=form.cleaned_data["csv_file"],
+            send_emails=form.cleaned_data["send_emails"],
+            login_url=self.request.build_absolute_uri('/'),
+            created_by=self.request.user,
+        )
+        transaction.on_commit(lambda: bulk_user_upload_settings.UPLOAD_JOB_RUNNER(job))
+        messages.add_message(self.request, messages.INFO, f"The upload will be processed in the background as job {job.pk}.")
+        return HttpResponseRedirect(reverse("admin:bulk-upload-job", args=[job.pk]))
+
+    def get_report_context(self, report, df):
+        """
+        Context for one page each of the error and warning rows of an issue report, along with the number of rows with
+        each type of issue and the report's download links. The pages are chosen by the errors_page and warnings_page
+        query parameters.
+        """
+        context = dict(
+            report_id=report.report_id,
+            report_downloads=[
+                (file_format.upper(), reverse("admin:bulk-upload-report-download", args=[report.report_id, file_format]))
+                for file_format in ("csv", "xlsx")
+            ],
+        )
+        user_field_validators = [column for column in self.user_field_validators if column in df]
+        for kind in ("errors", "warnings"):
+            if kind not in df:
+                continue
+            flagged = df[df[kind] != ""]
+            if flagged.empty:
+                continue
+            columns = ["row", kind, *user_field_validators]
+            page_param = f"{kind}_page"
+            page = Paginator(flagged, self.report_page_size).get_page(self.request.GET.get(page_param))
+            context[kind] = dict(
+                count=len(flagged),
+                summary=summarize_issues(flagged[kind]),
+                columns=columns,
+                rows=page.object_list[columns].values.tolist(),
+                page=page,
+                previous_query=self.get_page_query(report, page_param, page.previous_page_number())
+                if page.has_previous() else None,
+                next_query=self.get_page_query(report, page_param, page.next_page_number())
+                if page.has_next() else None,
+            )
+        return context
+
+    def get_page_query(self, report, page_param, number):
+        """The query string of the report showing page `number` of one table, keeping the other table's page."""
+        query = self.request.GET.copy()
+        query["report"] = report.report_id
+        query[page_param] = number
+        return query.urlencode()
+
+    def render_report(self, report_id):
+        try:
+            report = IssueReport(report_id)
+        except ValueError:
+            raise Http404("Issue report not found.")
+        if not report.exists():
+            raise Http404("The issue report has expired; upload the file again to see its issues.")
+        context_data = self.get_context_data()
+        context_data.update(self.get_report_context(report, report.load()))
+        return self.render_to_response(context_data)
+
+    def form_invalid(self, form):
         context_data = self.get_context_data(form=form)
-        df = form.uploaded_data
-        if "warnings" in df or "errors" in form.uploaded_data:
-            user_field_validators = self.user_field_validators
-            if "warnings" in df:
-                context_data["warnings"] = df[df["warnings"].apply(bool)][["row", "warnings", *user_field_validators]].to_html(
-                    index=False
-                )
-            if "errors" in form.uploaded_data:
-                context_data["errors"] = df[df["errors"].apply(bool)][["row", "errors", *user_field_validators]].to_html(index=False)
-        if created:
-            context_data["created"] = pandas.DataFrame(
-                [dict(username=getattr(u, self.username_field), email=u.email) for u in created]
-            ).to_html(index=False)
+        if form.count_issues("warnings") or form.count_issues("errors"):
+            # only one page of each table is rendered; the rest are paged through or downloaded from the stored report
+            df = form.uploaded_data
+            context_data.update(self.get_report_context(IssueReport.save(df), df))
+        if self.tracer is not None and self.request.user.is_staff:
+            context_data["stage_timings"] = self.tracer.summary()
         return self.render_to_response(context_data)
 
     def get_success_url(self):
@@ -141,3 +299,55 @@ class BulkUploadUsers(generic.FormView):
             )
         )
         return context
+
+
+class IssueReportDownload(generic.View):
+    """Downloads an issue report as CSV, streamed from storage, or as an Excel workbook if openpyxl is installed."""
+
+    @method_decorator(
+        permission_required(["users.add_user", "users.change_user"], raise_exception=True),
+    )
+    def get(self, request, report_id, file_format):
+        try:
+            report = IssueReport(report_id)
+        except ValueError:
+            raise Http404("Issue report not found.")
+        if file_format not in ("csv", "xlsx") or not report.exists():
+            raise Http404("Issue report not found.")
+        file_name = f"bulk-upload-issues-{report_id[:8]}.{file_format}"
+        if file_format == "csv":
+            return FileResponse(report.open(), as_attachment=True, filename=file_name, content_type="text/csv")
+        try:
+            content = report.to_xlsx()
+        except ImportError:
+            raise Http404("Excel downloads require openpyxl to be installed.")
+        response = HttpResponse(
+            content, content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+        response["Content-Disposition"] = f'attachment; filename="{file_name}"'
+        return response
+
+
+class UploadJobStatus(generic.DetailView):
+    model = UploadJob
+    template_name = "admin/bulk_upload_job.html"
+    context_object_name = "job"
+    refresh_seconds = 2
+
+    @method_decorator(
+        permission_required(["users.add_user", "users.change_user"], raise_exception=True),
+    )
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update(
+            dict(
+                is_popup=True,
+                is_popup_var=IS_POPUP_VAR,
+                refresh_seconds=None if self.object.is_finished else self.refresh_seconds,
+                form_url=reverse("admin:bulk-upload-users"),
+            )
+        )
+        return context
@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+
+
+class BulkUserUploadConfig(AppConfig):
+    name = "bulk_user_upload"
+    verbose_name = "Bulk user upload"
+    default_auto_field = "django.db.models.AutoField"
+
+    def ready(self):
+        from bulk_user_upload import lookups
+        lookups.connect_signals()
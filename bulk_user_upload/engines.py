@@ -0,0 +1,779 @@
+"""
+Tabular engines: the table operations the upload pipeline is built on, e.g. reading an upload in chunks, selecting
+columns, mapping and masking them, finding duplicates and turning rows into records. The form reads each upload with
+the engine chosen by the UPLOAD_ENGINE setting, and the preprocessor, validators and creator run the operations of the
+engine that owns the tables they are given, found with `engine_of`; the same USERS_VALIDATOR and USERS_CREATOR work
+with every engine.
+
+The pandas engine processes uploads as DataFrames. The csv engine reads them with the csv module into plain Python
+lists, which cost far less per operation than pandas does; it suits small uploads, and doesn't need pandas or numpy
+at all unless an upload's issues are reported. The polars engine, if polars is installed, keeps uploads in Arrow
+columns and runs the regex checks, duplicate detection, lowercasing and list splitting as native multithreaded kernels;
+it suits very large uploads.
+"""
+from __future__ import annotations
+
+import csv
+import io
+import logging
+import re
+from collections import Counter
+from contextlib import contextmanager
+
+from bulk_user_upload.lazy import lazy_import
+from bulk_user_upload.settings import bulk_user_upload_settings
+
+pandas = lazy_import("pandas")
+try:
+    # optional; see PolarsEngine
+    polars = lazy_import("polars")
+except ImportError:
+    polars = None
+
+logger = logging.getLogger(__file__)
+
+
+class BaseEngine:
+    """
+    The operations on tables of uploaded users, and on their columns, that the upload pipeline runs. A table keeps the
+    position of each of its rows in the whole upload as its `index`, and can be indexed by column name; a column keeps
+    the positions of its values. Masks are columns of booleans.
+    """
+    name = None
+    # whether chunks can be validated in forked worker processes; see BaseUsersValidator.workers
+    fork_safe = True
+
+    @staticmethod
+    def is_available() -> bool:
+        """Whether the libraries the engine needs are installed."""
+        return True
+
+    def owns(self, obj) -> bool:
+        """Whether `obj` is a table, column or row of this engine."""
+        raise NotImplementedError
+
+    def read_chunks(self, source, columns, chunk_size):
+        """Yields the `columns` of the CSV `source`, a path or a binary file object, `chunk_size` rows at a time."""
+        raise NotImplementedError
+
+    # tables
+
+    def select(self, table, columns):
+        raise NotImplementedError
+
+    def column(self, table, name):
+        """The column `name` of `table`, or a column of None if `table` has no such column."""
+        raise NotImplementedError
+
+    def slice(self, table, start, stop):
+        """The rows of `table` from position `start` up to `stop`."""
+        raise NotImplementedError
+
+    def concat(self, tables):
+        """The rows of `tables`, one table after the other, keeping their index."""
+        raise NotImplementedError
+
+    def take(self, table, rows):
+        """The rows of `table` whose index is in `rows`."""
+        raise NotImplementedError
+
+    def mask(self, table, mask):
+        """The rows of `table` whose entry in `mask` is true."""
+        raise NotImplementedError
+
+    def join(self, table, columns, separator):
+        """A column of the values of `columns` in each row, as strings joined by `separator`."""
+        raise NotImplementedError
+
+    def records(self, table):
+        """The rows of `table` as a list of dicts."""
+        raise NotImplementedError
+
+    def apply_rows(self, table, function):
+        """Calls `function` with each row of `table`, which has a `get` method and its index as `name`."""
+        raise NotImplementedError
+
+    def to_frame(self, table):
+        """`table` as a pandas DataFrame, e.g. to report its rows."""
+        raise NotImplementedError
+
+    # columns
+
+    def make_column(self, values, rows):
+        raise NotImplementedError
+
+    def rows(self, column):
+        """The index of each value of `column`."""
+        raise NotImplementedError
+
+    def map(self, column, function):
+        raise NotImplementedError
+
+    def lower(self, column):
+        raise NotImplementedError
+
+    def mismatches(self, column, regex):
+        """A mask of the values of `column` that don't match the compiled `regex`."""
+        raise NotImplementedError
+
+    def isin(self, column, values):
+        raise NotImplementedError
+
+    def not_in(self, column, values):
+        raise NotImplementedError
+
+    def duplicated(self, column, seen=()):
+        """A mask of the values of `column` that appear in it more than once, or that are in `seen`."""
+        raise NotImplementedError
+
+    def first_occurrences(self, column):
+        """The index and value of the first occurrence of each distinct value of `column`, as two lists."""
+        raise NotImplementedError
+
+    def split_lists(self, column):
+        """
+        Splits a column of comma-separated lists into its stripped, non-empty items. Returns two lists: the index of the
+        row of each item, in row order, and the items.
+        """
+        raise NotImplementedError
+
+    def collect_by_row(self, column, rows, items):
+        """A column aligned with `column` holding the list of `items` of each of its rows in `rows`, or None."""
+        raise NotImplementedError
+
+    def flagged(self, column, invalid):
+        """
+        The index, value and `invalid` entry of the rows of `column` that `invalid` marks as invalid, as three
+        sequences; the entries are None if `invalid` is a mask.
+        """
+        raise NotImplementedError
+
+
+def split_list_column(column: pandas.Series) -> pandas.Series:
+    """Splits a column of comma-separated lists into one stripped, non-empty item per entry, indexed by row."""
+    items = column.astype(str).str.split(",").explode().str.strip()
+    return items[items != ""]
+
+
+class PandasEngine(BaseEngine):
+    """Processes uploads as pandas DataFrames, with vectorized operations that suit large uploads."""
+    name = "pandas"
+
+    def owns(self, obj):
+        return isinstance(obj, (pandas.DataFrame, pandas.Series, pandas.Index))
+
+    @staticmethod
+    def get_column_dtypes(columns):
+        """Every column is read as strings, and the low-cardinality `CATEGORICAL_COLUMNS` as categoricals."""
+        categorical = set(bulk_user_upload_settings.CATEGORICAL_COLUMNS or [])
+        return {column: "category" if column in categorical else str for column in columns}
+
+    def read_chunks(self, source, columns, chunk_size):
+        """
+        Reads the CSV with the CSV_ENGINE setting's parser, typed by `get_column_dtypes`; the other columns are never
+        parsed, and a path is memory-mapped.
+        """
+        parser = bulk_user_upload_settings.CSV_ENGINE
+        if parser == "pyarrow":
+            try:
+                yield from self.read_chunks_with_pyarrow(source, columns, chunk_size)
+                return
+            except ImportError:
+                logger.warning("CSV_ENGINE is 'pyarrow' but pyarrow is not installed; using the 'c' engine instead.")
+                parser = "c"
+        wanted = set(columns)
+        reader = pandas.read_csv(
+            source,
+            keep_default_na=False,
+            chunksize=chunk_size,
+            usecols=lambda column: column in wanted,
+            dtype=self.get_column_dtypes(columns),
+            engine=parser,
+            memory_map=isinstance(source, str) and parser == "c",
+        )
+        with reader:
+            yield from reader
+
+    def read_chunks_with_pyarrow(self, source, columns, chunk_size):
+        """
+        Streams the CSV with pyarrow's multithreaded reader, which pandas' own pyarrow engine cannot do in chunks; a
+        path is memory-mapped. Row indexes are numbered across the pyarrow record batches, as the pandas reader numbers
+        them across chunks.
+        """
+        import pyarrow
+        from pyarrow import csv as pyarrow_csv
+
+        column_types = {
+            column: pyarrow.dictionary(pyarrow.int32(), pyarrow.string()) if dtype == "category" else pyarrow.string()
+            for column, dtype in self.get_column_dtypes(columns).items()
+        }
+        reader = pyarrow_csv.open_csv(
+            pyarrow.memory_map(source) if isinstance(source, str) else source,
+            convert_options=pyarrow_csv.ConvertOptions(
+                include_columns=list(columns), column_types=column_types, strings_can_be_null=False
+            ),
+        )
+        offset = 0
+        for batch in reader:
+            users = batch.to_pandas()
+            users.index = pandas.RangeIndex(offset, offset + len(users))
+            offset += len(users)
+            for start in range(0, len(users), chunk_size):
+                yield users.iloc[start:start + chunk_size]
+
+    def select(self, table, columns):
+        return table[list(columns)]
+
+    def column(self, table, name):
+        return table[name] if name in table else pandas.Series(None, index=table.index, dtype=object)
+
+    def slice(self, table, start, stop):
+        return table.iloc[start:stop]
+
+    def concat(self, tables):
+        return pandas.concat(tables)
+
+    def take(self, table, rows):
+        return table[table.index.isin(rows)]
+
+    def mask(self, table, mask):
+        return table[mask.values]
+
+    def join(self, table, columns, separator):
+        joined = table[columns[0]].astype(str)
+        return joined.str.cat([table[column].astype(str) for column in columns[1:]], sep=separator)
+
+    def records(self, table):
+        return table.to_dict("records")
+
+    def apply_rows(self, table, function):
+        table.apply(function, axis=1)
+
+    def to_frame(self, table):
+        return table
+
+    def make_column(self, values, rows):
+        return pandas.Series(values, index=rows, dtype=object)
+
+    def rows(self, column):
+        return column.index
+
+    def map(self, column, function):
+        mapped = column.map(function)
+        # a categorical column is mapped once per category; the result is read as a plain column
+        return mapped.astype(object) if isinstance(mapped.dtype, pandas.CategoricalDtype) else mapped
+
+    def lower(self, column):
+        return column.str.lower()
+
+    def mismatches(self, column, regex):
+        return ~column.astype(str).str.match(regex.pattern, flags=regex.flags).astype(bool)
+
+    def isin(self, column, values):
+        return column.isin(values)
+
+    def not_in(self, column, values):
+        return ~column.isin(values)
+
+    def duplicated(self, column, seen=()):
+        return column.duplicated(keep=False) | column.isin(seen)
+
+    def first_occurrences(self, column):
+        first = column[~column.duplicated()]
+        return first.index.tolist(), first.tolist()
+
+    def split_lists(self, column):
+        items = split_list_column(column)
+        return items.index.tolist(), items.tolist()
+
+    def collect_by_row(self, column, rows, items):
+        if not rows:
+            return pandas.Series(None, index=column.index, dtype=object)
+        return pandas.Series(items, index=rows, dtype=object).groupby(level=0).agg(list).reindex(column.index)
+
+    def flagged(self, column, invalid):
+        mask = invalid if invalid.dtype == bool else invalid.fillna(False).astype(bool)
+        return (
+            column.index[mask.values], column[mask].values, None if invalid.dtype == bool else invalid[mask].values
+        )
+
+
+class Column(list):
+    """A column of a csv engine table: its values, with the index of the row of each value as `rows`."""
+
+    def __init__(self, values=(), rows=()):
+        super().__init__(values)
+        self.rows = rows
+
+
+class Row(dict):
+    """A row of a csv engine table, by column name, with its index as `name` like a row of a DataFrame."""
+
+    def __init__(self, values, name):
+        super().__init__(values)
+        self.name = name
+
+
+class Table:
+    """
+    A chunk of an upload read by the csv engine: the list of values of each column, by name, and the index of each row.
+    Like a DataFrame, it has `columns`, `index` and `empty`, and indexing it with a column name returns the column.
+    """
+
+    def __init__(self, data, index):
+        self.data = data
+        self.index = index
+
+    @property
+    def columns(self):
+        return list(self.data)
+
+    @property
+    def empty(self):
+        return not self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.data
+
+    def __getitem__(self, key):
+        if isinstance(key, list):
+            return Table({name: self.data[name] for name in key}, self.index)
+        return Column(self.data[key], self.index)
+
+    def __setitem__(self, name, values):
+        self.data[name] = list(values)
+
+    def copy(self):
+        return Table({name: list(values) for name, values in self.data.items()}, list(self.index))
+
+
+class CsvEngine(BaseEngine):
+    """Processes uploads as plain Python lists read with the csv module, which cost little per operation."""
+    name = "csv"
+
+    def owns(self, obj):
+        return isinstance(obj, (Table, Column, Row))
+
+    @staticmethod
+    @contextmanager
+    def open_text(source):
+        if isinstance(source, str):
+            with open(source, newline="", encoding="utf-8-sig") as f:
+                yield f
+            return
+        f = io.TextIOWrapper(source, encoding="utf-8-sig", newline="")
+        try:
+            yield f
+        finally:
+            # leaves the upload open, to be read again
+            f.detach()
+
+    def read_chunks(self, source, columns, chunk_size):
+        """Reads every value as a string; blank lines are skipped and missing trailing values read as ""."""
+        with self.open_text(source) as f:
+            reader = csv.reader(f)
+            headers = next(reader, None) or []
+            positions = [headers.index(column) for column in columns]
+            offset = 0
+            records = []
+            for record in reader:
+                if not record:
+                    continue
+                records.append(record)
+                if len(records) == chunk_size:
+                    yield self.make_table(records, columns, positions, offset)
+                    offset += len(records)
+                    records = []
+            if records:
+                yield self.make_table(records, columns, positions, offset)
+
+    @staticmethod
+    def make_table(records, columns, positions, offset):
+        data = {
+            column: [record[position] if position < len(record) else "" for record in records]
+            for column, position in zip(columns, positions)
+        }
+        return Table(data, list(range(offset, offset + len(records))))
+
+    def select(self, table, columns):
+        return table[list(columns)]
+
+    def column(self, table, name):
+        return table[name] if name in table else Column([None] * len(table), table.index)
+
+    def slice(self, table, start, stop):
+        return Table({name: values[start:stop] for name, values in table.data.items()}, table.index[start:stop])
+
+    def concat(self, tables):
+        return Table(
+            {name: [value for table in tables for value in table.data[name]] for name in tables[0].columns},
+            [row for table in tables for row in table.index],
+        )
+
+    def take(self, table, rows):
+        rows = set(rows)
+        return self.mask(table, [row in rows for row in table.index])
+
+    def mask(self, table, mask):
+        positions = [position for position, selected in enumerate(mask) if selected]
+        return Table(
+            {name: [values[position] for position in positions] for name, values in table.data.items()},
+            [table.index[position] for position in positions],
+        )
+
+    def join(self, table, columns, separator):
+        values = zip(*(table.data[column] for column in columns))
+        return Column([separator.join(str(value) for value in row) for row in values], table.index)
+
+    def records(self, table):
+        columns = table.columns
+        return [dict(zip(columns, values)) for values in zip(*(table.data[column] for column in columns))]
+
+    def apply_rows(self, table, function):
+        for name, record in zip(table.index, self.records(table)):
+            function(Row(record, name))
+
+    def to_frame(self, table):
+        return pandas.DataFrame(table.data, index=pandas.Index(table.index), columns=table.columns, dtype=object)
+
+    def make_column(self, values, rows):
+        return Column(values, rows)
+
+    def rows(self, column):
+        return column.rows
+
+    def map(self, column, function):
+        return Column([function(value) for value in column], column.rows)
+
+    def lower(self, column):
+        return Column([value.lower() for value in column], column.rows)
+
+    def mismatches(self, column, regex):
+        return Column([not regex.match(str(value)) for value in column], column.rows)
+
+    def isin(self, column, values):
+        values = values if isinstance(values, (set, frozenset, dict)) else set(values)
+        return Column([value in values for value in column], column.rows)
+
+    def not_in(self, column, values):
+        values = values if isinstance(values, (set, frozenset, dict)) else set(values)
+        return Column([value not in values for value in column], column.rows)
+
+    def duplicated(self, column, seen=()):
+        counts = Counter(column)
+        return Column([counts[value] > 1 or value in seen for value in column], column.rows)
+
+    def first_occurrences(self, column):
+        first_rows = {}
+        for row, value in zip(column.rows, column):
+            first_rows.setdefault(value, row)
+        return list(first_rows.values()), list(first_rows)
+
+    def split_lists(self, column):
+        rows = []
+        items = []
+        for row, value in zip(column.rows, column):
+            for item in str(value).split(","):
+                item = item.strip()
+                if item:
+                    rows.append(row)
+                    items.append(item)
+        return rows, items
+
+    def collect_by_row(self, column, rows, items):
+        items_by_row = {}
+        for row, item in zip(rows, items):
+            items_by_row.setdefault(row, []).append(item)
+        return Column([items_by_row.get(row) for row in column.rows], column.rows)
+
+    def flagged(self, column, invalid):
+        rows = []
+        values = []
+        details = []
+        for row, value, result in zip(column.rows, column, invalid):
+            if result:
+                rows.append(row)
+                values.append(value)
+                details.append(result)
+        return rows, values, None if all(detail is True for detail in details) else details
+
+
+class PolarsColumn:
+    """A column of a polars engine table: a polars Series of its values, and one of the index of each value."""
+
+    def __init__(self, values, rows):
+        self.values = values
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+
+class PolarsTable:
+    """
+    A chunk of an upload read by the polars engine: a polars DataFrame, and a polars Series of the index of each of
+    its rows. Like a DataFrame, it has `columns`, `index` and `empty`, and indexing it with a column name returns the
+    column.
+    """
+
+    def __init__(self, frame, index):
+        self.frame = frame
+        self.index = index
+
+    @property
+    def columns(self):
+        return self.frame.columns
+
+    @property
+    def empty(self):
+        return not len(self)
+
+    def __len__(self):
+        return self.frame.height
+
+    def __contains__(self, name):
+        return name in self.frame.columns
+
+    def __getitem__(self, key):
+        if isinstance(key, list):
+            return PolarsTable(self.frame.select(key), self.index)
+        return PolarsColumn(self.frame[key], self.index)
+
+    def __setitem__(self, name, values):
+        values = values.values if isinstance(values, PolarsColumn) else polars.Series(list(values))
+        self.frame = self.frame.with_columns(values.alias(name))
+
+    def copy(self):
+        return PolarsTable(self.frame.clone(), self.index.clone())
+
+
+class PolarsEngine(BaseEngine):
+    """
+    Processes uploads as polars DataFrames of Arrow string columns, whose kernels run natively and in parallel; it suits
+    very large uploads, where pandas' object columns dominate runtime and memory. Requires polars 0.20 or later.
+    """
+    name = "polars"
+    # polars' thread pool deadlocks in forked processes, and its kernels already run in parallel
+    fork_safe = False
+
+    @staticmethod
+    def is_available():
+        return polars is not None
+
+    def owns(self, obj):
+        return isinstance(obj, (PolarsTable, PolarsColumn))
+
+    def read_chunks(self, source, columns, chunk_size):
+        """
+        Streams the `columns` with polars' multithreaded reader, as Arrow strings with missing values as "", in chunks
+        of `chunk_size` rows; the upload's other columns are never parsed.
+        """
+        start = 0
+        pending = None
+        for batch in self.read_batches(source, list(columns), chunk_size):
+            # the reader's batches are only roughly `chunk_size` rows, so they are cut into chunks of exactly that size
+            pending = batch if pending is None else polars.concat([pending, batch])
+            while pending.height >= chunk_size:
+                yield self.to_table(pending.slice(0, chunk_size), start)
+                pending = pending.slice(chunk_size)
+                start += chunk_size
+        if pending is not None and pending.height:
+            yield self.to_table(pending, start)
+
+    @staticmethod
+    def read_batches(source, columns, chunk_size):
+        """
+        Yields the `columns` of the CSV `source` in batches of about `chunk_size` rows: from a lazy scan where polars
+        can collect one in batches, otherwise from polars' batched reader. Older versions of polars can only read a
+        file object at once, which costs little as such an upload is already in memory.
+        """
+        if hasattr(polars.LazyFrame, "collect_batches"):
+            yield from polars.scan_csv(source, infer_schema_length=0).select(columns).collect_batches(
+                chunk_size=chunk_size
+            )
+        elif isinstance(source, str):
+            reader = polars.read_csv_batched(source, columns=columns, infer_schema_length=0, batch_size=chunk_size)
+            while True:
+                batches = reader.next_batches(1)
+                if not batches:
+                    break
+                yield from batches
+        else:
+            yield polars.read_csv(source, columns=columns, infer_schema_length=0)
+
+    @staticmethod
+    def to_table(users, start):
+        """A PolarsTable of `users`, whose missing values become "", numbered on from row `start` of the upload."""
+        index = polars.Series("row", list(range(start, start + users.height)), dtype=polars.Int64)
+        return PolarsTable(users.with_columns(polars.all().fill_null("")), index)
+
+    def select(self, table, columns):
+        return table[list(columns)]
+
+    def column(self, table, name):
+        if name in table:
+            return table[name]
+        return PolarsColumn(polars.Series(name, [None] * len(table), dtype=polars.Utf8), table.index)
+
+    def slice(self, table, start, stop):
+        return PolarsTable(table.frame.slice(start, stop - start), table.index.slice(start, stop - start))
+
+    def concat(self, tables):
+        return PolarsTable(
+            polars.concat([table.frame for table in tables]), polars.concat([table.index for table in tables])
+        )
+
+    def take(self, table, rows):
+        rows = polars.Series([int(row) for row in rows], dtype=polars.Int64)
+        return self.mask(table, PolarsColumn(table.index.is_in(rows), table.index))
+
+    def mask(self, table, mask):
+        mask = mask.values.fill_null(False)
+        return PolarsTable(table.frame.filter(mask), table.index.filter(mask))
+
+    def join(self, table, columns, separator):
+        joined = table.frame.select(
+            polars.concat_str([polars.col(column).cast(polars.Utf8) for column in columns], separator=separator)
+        )
+        return PolarsColumn(joined.to_series(), table.index)
+
+    def records(self, table):
+        return table.frame.to_dicts()
+
+    def apply_rows(self, table, function):
+        for name, record in zip(table.index, table.frame.iter_rows(named=True)):
+            function(Row(record, name))
+
+    def to_frame(self, table):
+        return pandas.DataFrame(
+            table.frame.to_dict(as_series=False),
+            index=pandas.Index(table.index.to_list()),
+            columns=table.columns,
+            dtype=object,
+        )
+
+    def make_column(self, values, rows):
+        return PolarsColumn(polars.Series(list(values)), polars.Series(list(rows), dtype=polars.Int64))
+
+    def rows(self, column):
+        return column.rows
+
+    def map(self, column, function):
+        """Calls `function` once per distinct value, rather than once per row."""
+        results = {value: function(value) for value in column.values.unique().to_list()}
+        mapped = [results[value] for value in column.values]
+        is_mask = all(result is None or isinstance(result, bool) for result in results.values())
+        return PolarsColumn(polars.Series(mapped, dtype=polars.Boolean if is_mask else polars.Object), column.rows)
+
+    def lower(self, column):
+        return PolarsColumn(column.values.str.to_lowercase(), column.rows)
+
+    def mismatches(self, column, regex):
+        """Runs `regex` with polars' regex engine, or in Python if it uses syntax that polars doesn't support."""
+        flags = "".join(
+            flag for re_flag, flag in ((re.IGNORECASE, "i"), (re.MULTILINE, "m"), (re.DOTALL, "s"))
+            if regex.flags & re_flag
+        )
+        # anchored at the start, as re.match is
+        pattern = f"{f'(?{flags})' if flags else ''}^(?:{regex.pattern})"
+        try:
+            matched = column.values.cast(polars.Utf8).str.contains(pattern)
+        except polars.exceptions.ComputeError:
+            return self.map(column, lambda value: not regex.match(str(value)))
+        return PolarsColumn(~matched.fill_null(False), column.rows)
+
+    def isin(self, column, values):
+        # values looked up in the database may be of other types than the column, e.g. integers in a string column
+        values = polars.Series(list(values), dtype=column.values.dtype, strict=False)
+        return PolarsColumn(column.values.is_in(values), column.rows)
+
+    def not_in(self, column, values):
+        return PolarsColumn(~self.isin(column, values).values, column.rows)
+
+    def duplicated(self, column, seen=()):
+        return PolarsColumn(column.values.is_duplicated() | self.isin(column, seen).values, column.rows)
+
+    def first_occurrences(self, column):
+        first = polars.DataFrame({"row": column.rows, "value": column.values}).unique(
+            subset="value", keep="first", maintain_order=True
+        )
+        return first["row"].to_list(), first["value"].to_list()
+
+    def split_lists(self, column):
+        items = polars.DataFrame({"row": column.rows, "item": column.values.cast(polars.Utf8).str.split(",")})
+        items = items.explode("item").with_columns(polars.col("item").str.strip_chars())
+        items = items.filter(polars.col("item").is_not_null() & (polars.col("item") != ""))
+        return items["row"].to_list(), items["item"].to_list()
+
+    def collect_by_row(self, column, rows, items):
+        items_by_row = {}
+        for row, item in zip(rows, items):
+            items_by_row.setdefault(row, []).append(item)
+        collected = [items_by_row.get(row) for row in column.rows] if items_by_row else [None] * len(column)
+        return PolarsColumn(polars.Series(collected, dtype=polars.List(polars.Utf8)), column.rows)
+
+    def flagged(self, column, invalid):
+        results = invalid.values
+        if results.dtype == polars.Boolean:
+            mask = results.fill_null(False)
+        elif results.dtype == polars.List:
+            mask = results.is_not_null()
+        else:
+            mask = polars.Series([bool(result) for result in results], dtype=polars.Boolean)
+        details = None if results.dtype == polars.Boolean else [
+            result for result, selected in zip(results.to_list(), mask) if selected
+        ]
+        return column.rows.filter(mask).to_list(), column.values.filter(mask).to_list(), details
+
+
+engines = {
+    CsvEngine.name: CsvEngine(),
+    PolarsEngine.name: PolarsEngine(),
+    # last, as telling whether it owns an object loads pandas
+    PandasEngine.name: PandasEngine(),
+}
+
+
+def get_engine(name) -> BaseEngine:
+    try:
+        return engines[name]
+    except KeyError:
+        raise ValueError(f"Unknown upload engine {name!r}; expected one of {['auto', *engines]}")
+
+
+def select_engine(name=None, size=None) -> BaseEngine:
+    """
+    The engine named `name`, by default the UPLOAD_ENGINE setting. 'auto' selects the csv engine for uploads of at most
+    SMALL_UPLOAD_SIZE bytes, the polars engine, if it is installed, for uploads of more than LARGE_UPLOAD_SIZE bytes,
+    and the pandas engine otherwise, e.g. for uploads of unknown `size`. An engine that isn't installed falls back to
+    the pandas engine.
+    """
+    name = name or bulk_user_upload_settings.UPLOAD_ENGINE
+    if name == "auto":
+        small_size = bulk_user_upload_settings.SMALL_UPLOAD_SIZE
+        large_size = bulk_user_upload_settings.LARGE_UPLOAD_SIZE
+        if size is not None and small_size and size <= small_size:
+            name = CsvEngine.name
+        elif size is not None and large_size and size > large_size and PolarsEngine.is_available():
+            name = PolarsEngine.name
+        else:
+            name = PandasEngine.name
+    engine = get_engine(name)
+    if not engine.is_available():
+        logger.warning(f"UPLOAD_ENGINE is {name!r} but it is not installed; using the 'pandas' engine instead.")
+        return engines[PandasEngine.name]
+    return engine
+
+
+def engine_of(obj) -> BaseEngine:
+    """The engine that owns the table, column or row `obj`."""
+    for engine in engines.values():
+        if engine.owns(obj):
+            return engine
+    raise TypeError(f"No upload engine owns {type(obj).__name__} objects")
@@ -1,20 +1,44 @@
-import tempfile
-from pathlib import Path
+from __future__ import annotations
+
+import csv
+import hashlib
+import logging
+import os
 
 from django import forms
 from django.core.exceptions import ValidationError
+from django.utils.functional import cached_property
 
+from bulk_user_upload import tracing
+from bulk_user_upload.engines import BaseEngine, select_engine
+from bulk_user_upload.lazy import lazy_import
 from bulk_user_upload.settings import bulk_user_upload_settings
 
-import pandas
+from bulk_user_upload.utils import FieldValidator, IssueList, UploadCache, cached_validation_tuple, get_users_validator
+
+numpy = lazy_import("numpy")
+pandas = lazy_import("pandas")
 
-from bulk_user_upload.utils import FieldValidator
+logger = logging.getLogger(__file__)
 
 
 class BulkUserUploadForm(forms.Form):
-    uploaded_data = pandas.DataFrame()
+    _uploaded_data = None
+    row_count = 0
+    defer_processing = False
+    # group and permission memberships parsed during validation, reused when the users are created
+    memberships = None
+    # reject uploads of more than MAX_UPLOAD_ROWS rows; the bulk_upload_users management command turns this off
+    limit_rows = True
+    validation_workers = None  # defaults to VALIDATION_WORKERS
+    engine_name = None  # defaults to UPLOAD_ENGINE; see bulk_user_upload.engines
+    # reuse the cached validation of an identical upload; see UPLOAD_CACHE_TIMEOUT
+    use_upload_cache = True
     csv_file = forms.FileField(label="CSV File")
     send_emails = forms.BooleanField(initial=bulk_user_upload_settings.SEND_EMAILS_BY_DEFAULT, required=False)
+    force = forms.BooleanField(
+        required=False, label="Process again", help_text="Create the users even if this file was recently uploaded."
+    )
     field_validator_cls = FieldValidator
     field_validator_overrides = bulk_user_upload_settings.USER_FIELD_VALIDATORS
     username_field = bulk_user_upload_settings.USERNAME_FIELD
@@ -26,51 +50,195 @@ class BulkUserUploadForm(forms.Form):
 
     @property
     def users_validator(self):
-        return bulk_user_upload_settings.USERS_VALIDATOR(
+        return get_users_validator(
+            bulk_user_upload_settings.USERS_VALIDATOR,
             username_field=self.username_field,
             email_field=self.email_field,
             field_validator_cls=self.field_validator_cls,
             field_validator_overrides=self.field_validator_overrides,
+            workers=self.validation_workers or bulk_user_upload_settings.VALIDATION_WORKERS,
         )
 
-    def is_valid(self, validate_only=False):
+    @property
+    def uploaded_data(self) -> pandas.DataFrame:
+        """The rows of the upload that have issues, with their row number, errors and warnings; empty until validated."""
+        if self._uploaded_data is None:
+            self._uploaded_data = pandas.DataFrame()
+        return self._uploaded_data
+
+    @uploaded_data.setter
+    def uploaded_data(self, uploaded_data: pandas.DataFrame):
+        self._uploaded_data = uploaded_data
+
+    def count_issues(self, kind) -> int:
+        """
+        The number of rows of the report with `kind` issues, "errors" or "warnings"; pandas isn't loaded for an upload
+        without a report.
+        """
+        if self._uploaded_data is None or kind not in self._uploaded_data:
+            return 0
+        return int((self._uploaded_data[kind] != "").sum())
+
+    def is_valid(self, validate_only=False, defer_processing=False):
+        """
+        With `defer_processing`, only the presence of the CSV file is checked; the upload is validated later by the
+        background job that processes it.
+        """
         self.validate_only = validate_only
+        self.defer_processing = defer_processing
         return super().is_valid()
 
     @staticmethod
-    def _prepare_errors_and_warnings(users: pandas.DataFrame, errors, warnings):
+    def _prepare_errors_and_warnings(users: pandas.DataFrame, errors: IssueList, warnings: IssueList):
+        # categorical columns would not accept the new "" values of the report
+        users = users.astype(object)
         users["row"] = users.index + 2
-        user_records = users.to_dict("records")
-        for idx, error_list in errors.items():
-            user_records[idx]["errors"] = "; ".join(error_list)
-        for idx, warning_list in warnings.items():
-            user_records[idx]["warnings"] = "; ".join(warning_list)
-        return pandas.DataFrame(user_records).fillna("")
+        for kind, issues in (("errors", errors), ("warnings", warnings)):
+            if issues:
+                # messages are only built here, for the rows being reported
+                users[kind] = issues.render(users.index)
+        return users
+
+    def get_engine(self, csv_file) -> BaseEngine:
+        """The engine the upload is read and processed with, which may depend on its size."""
+        return select_engine(self.engine_name, csv_file.size)
+
+    def read_uploaded_chunks(self, csv_file):
+        """
+        Yields the uploaded CSV `UPLOAD_CHUNK_SIZE` rows at a time, keeping only the validated columns. The row index
+        of each chunk continues from the previous one, so it always refers to the row's position in the whole upload.
+        """
+        max_rows = bulk_user_upload_settings.MAX_UPLOAD_ROWS if self.limit_rows else None
+        user_field_validators = list(self.user_field_validators)
+        engine = self.get_engine(csv_file)
+        source = self.get_csv_source(csv_file)
+        headers = self.read_headers(source)
+        if not headers:
+            raise ValidationError("The uploaded CSV is empty.")
+        missing = [required for required in user_field_validators if required not in headers]
+        if any(missing):
+            raise ValidationError(f"Expected headers {missing}; got {headers}")
+        reader = engine.read_chunks(source, user_field_validators, bulk_user_upload_settings.UPLOAD_CHUNK_SIZE)
+        while True:
+            with tracing.span("parse") as span:
+                users = next(reader, None)
+                span["rows"] = 0 if users is None else len(users)
+            if users is None:
+                break
+            if users.empty:
+                continue
+            self.row_count = users.index[-1] + 1
+            if max_rows is not None and users.index[-1] >= max_rows:
+                raise ValidationError(f"Uploads are limited to {max_rows} at a time.")
+            yield engine.select(users, user_field_validators)
+
+    @staticmethod
+    def get_csv_source(csv_file):
+        """
+        Where the CSV parser reads the upload from, without copying it: the path of an upload that is already on the
+        local disk, such as a `TemporaryUploadedFile` or a file opened by path, which is memory-mapped; otherwise the
+        upload's own file object, e.g. the in-memory buffer of an `InMemoryUploadedFile`, rewound to its start.
+        """
+        if hasattr(csv_file, "temporary_file_path"):
+            return csv_file.temporary_file_path()
+        path = getattr(csv_file.file, "name", None)
+        if isinstance(path, str) and os.path.isfile(path):
+            return path
+        csv_file.seek(0)
+        return csv_file.file
+
+    @staticmethod
+    def read_headers(source):
+        """The column names on the first line of the CSV `source`; a file object is rewound after reading them."""
+        if isinstance(source, str):
+            with open(source, "rb") as f:
+                line = f.readline()
+        else:
+            line = source.readline()
+            source.seek(0)
+        return next(csv.reader([line.decode("utf-8-sig")]), None)
+
+    @cached_property
+    def content_hash(self):
+        """SHA-256 hex digest of the uploaded file, identifying the upload across submissions."""
+        digest = hashlib.sha256()
+        for chunk in self.cleaned_data["csv_file"].chunks():
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    @cached_property
+    def upload_cache(self):
+        """The upload's UploadCache, or None if caching is disabled."""
+        timeout = bulk_user_upload_settings.UPLOAD_CACHE_TIMEOUT
+        if not self.use_upload_cache or not timeout:
+            return None
+        return UploadCache(self.content_hash, timeout=timeout)
+
+    def get_previous_run(self):
+        """The recent run of an identical upload, or None if there was none or `force` was checked."""
+        if self.cleaned_data.get("force") or not self.upload_cache:
+            return None
+        return self.upload_cache.load_run()
+
+    def iter_uploaded_chunks(self):
+        """Yields the validated upload one chunk at a time, for creating the users once the form is valid."""
+        csv_file = self.cleaned_data.get("csv_file", None)
+        if csv_file:
+            yield from self.read_uploaded_chunks(csv_file)
 
     def clean(self):
-        self.uploaded_data = pandas.DataFrame()
+        self._uploaded_data = None
         csv_file = self.cleaned_data.get("csv_file", None)
-        if not csv_file:
+        if not csv_file or self.defer_processing:
             return self.cleaned_data
 
-        with tempfile.TemporaryDirectory() as temp_dir:
-            csv_file_path = Path(temp_dir) / "uploaded.csv"
-            with open(csv_file_path, "wb+") as wb:
-                for chunk in csv_file.chunks():
-                    wb.write(chunk)
-            users = pandas.read_csv(csv_file_path, keep_default_na=False)
-            if len(users) > 100:
-                raise ValidationError(f"Uploads are limited to 100 at a time.")
-            missing = [required for required in self.user_field_validators if required not in users.columns]
-            if any(missing):
-                raise ValidationError(f"Expected headers {missing}; got {list(users.columns)}")
-            users = users[self.user_field_validators]
-            errors, warnings = self.users_validator(users)
-            if self.validate_only or errors:
-                self.uploaded_data = self._prepare_errors_and_warnings(users, errors, warnings)
-                if errors:
-                    self.add_error(None, "Some rows contained validation errors.")
-                return self.cleaned_data
-            self.uploaded_data = users
+        upload_cache = self.upload_cache
+        # only the validations of valid uploads are cached, to submit them without validating them again in full
+        validation = upload_cache.load_validation() if upload_cache and not self.validate_only else None
+        if validation is not None and self.recheck_database(csv_file):
+            return self.clean_from_cache(validation)
+
+        users_validator = self.users_validator
+        errors, warnings = users_validator.validate_chunks(self.read_uploaded_chunks(csv_file))
+        field_validator = getattr(users_validator, "field_validator", None)
+        self.memberships = getattr(field_validator, "memberships", None)
+        # a clean upload has no report, so it isn't read a second time
+        if errors or (self.validate_only and warnings):
+            # only the rows with issues are kept in memory for the report
+            flagged = numpy.union1d(errors.rows(), warnings.rows())
+            engine = self.get_engine(csv_file)
+            with tracing.span("report", len(flagged)):
+                self.uploaded_data = pandas.concat(
+                    [
+                        self._prepare_errors_and_warnings(
+                            engine.to_frame(engine.take(users, flagged)).copy(), errors, warnings
+                        )
+                        for users in self.read_uploaded_chunks(csv_file)
+                    ] or [pandas.DataFrame()],
+                    ignore_index=True,
+                ).fillna("")
+        if errors:
+            self.add_error(None, "Some rows contained validation errors.")
+
+        if upload_cache and not errors:
+            upload_cache.save_validation(cached_validation_tuple(self.row_count))
+        return self.cleaned_data
+
+    def recheck_database(self, csv_file):
+        """
+        Runs the validator's database checks, such as the collisions with existing users, on the upload again, as the
+        users may have changed since its validation was cached; returns whether the upload still passes them.
+        """
+        errors, warnings = self.users_validator.recheck_chunks(self.read_uploaded_chunks(csv_file))
+        return not errors
 
+    def clean_from_cache(self, validation: cached_validation_tuple):
+        """
+        Takes the validation of a valid upload from the cache instead of validating it again in full. The group and
+        permission memberships are not cached; the users creator parses them again.
+        """
+        max_rows = bulk_user_upload_settings.MAX_UPLOAD_ROWS if self.limit_rows else None
+        if max_rows is not None and validation.row_count > max_rows:
+            raise ValidationError(f"Uploads are limited to {max_rows} at a time.")
+        self.row_count = validation.row_count
         return self.cleaned_data
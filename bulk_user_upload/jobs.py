@@ -0,0 +1,295 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import close_old_connections, connections, transaction
+from django.utils import timezone
+
+from bulk_user_upload import tracing
+from bulk_user_upload.models import UploadJob
+from bulk_user_upload.settings import bulk_user_upload_settings
+from bulk_user_upload.utils import (
+    CreationCheckpoint, creation_result_tuple, get_email_sender, get_users_creator, send_account_emails
+)
+
+logger = logging.getLogger(__file__)
+
+
+def build_users_creator(users_creator_cls=None, username_field=None, users_preprocessor_cls=None, batch_size=None):
+    """Instantiates the USERS_CREATOR, or `users_creator_cls`, with the settings for any argument not given."""
+    return get_users_creator(
+        users_creator_cls or bulk_user_upload_settings.USERS_CREATOR,
+        username_field=username_field or bulk_user_upload_settings.USERNAME_FIELD,
+        users_preprocessor_cls=users_preprocessor_cls or bulk_user_upload_settings.USERS_PREPROCESSOR,
+        batch_size=batch_size or bulk_user_upload_settings.CREATION_BATCH_SIZE,
+        upsert=bulk_user_upload_settings.UPDATE_EXISTING_USERS,
+    )
+
+
+def get_upload_error(form):
+    """The errors of an invalid upload form, joined into one message."""
+    return "; ".join(form.non_field_errors()) or "; ".join(
+        f"{field}: {'; '.join(errors)}" for field, errors in form.errors.items()
+    )
+
+
+def get_upload_issues(form, limit=None):
+    """The rows of a validated upload that have issues, up to `limit` of them, as dicts of their row and issues."""
+    if not form.count_issues("errors") and not form.count_issues("warnings"):
+        return []
+    issues = form.uploaded_data if limit is None else form.uploaded_data.head(limit)
+    return [
+        dict(row=int(issue["row"]), errors=issue.get("errors", ""), warnings=issue.get("warnings", ""))
+        for issue in issues.to_dict("records")
+    ]
+
+
+def create_uploaded_users(form, users_creator, upload_key, email=None, on_batch=None, batched=None):
+    """
+    Creates the users of the validated upload `form` with `users_creator`, and returns all of them as a creation result.
+
+    If `batched`, by default if the creator has a `batch_size`, each batch is committed on its own and checkpointed
+    under `upload_key`, so that running the same upload again after a failure resumes after its last committed batch;
+    otherwise all users are created in one transaction. `on_batch` is called with the creation result of each batch,
+    and `email` with the users created by each committed batch, or by the whole upload once it is committed.
+    """
+    users_creator.memberships = form.memberships
+    created = []
+    skipped = []
+    updated = []
+
+    def record(result):
+        created.extend(result.created)
+        skipped.extend(result.skipped)
+        updated.extend(result.updated)
+        if on_batch:
+            on_batch(result)
+
+    if batched is None:
+        batched = bool(users_creator.batch_size)
+    if batched:
+        checkpoint = CreationCheckpoint(upload_key, timeout=bulk_user_upload_settings.CREATION_CHECKPOINT_TIMEOUT)
+        for result in users_creator.create_in_batches(form.iter_uploaded_chunks(), checkpoint):
+            record(result)
+            if email and result.created:
+                email(result.created)
+        checkpoint.clear()
+    else:
+        with transaction.atomic():
+            for result in users_creator.create_in_batches(form.iter_uploaded_chunks()):
+                record(result)
+            if email and created:
+                # only email the new users once they have been committed
+                transaction.on_commit(lambda: email(created))
+    if form.upload_cache:
+        form.upload_cache.save_run(len(created), len(updated))
+    return creation_result_tuple(created, skipped, updated)
+
+
+class UploadJobProcessor:
+    """
+    Runs the upload pipeline for an UploadJob outside of the admin request: validates the stored CSV, creates the users
+    batch by batch and emails them, recording progress and the results of each stage on the job as it goes.
+    """
+    email_template_name = "email/account_creation_email.html"
+    email_sender_address = bulk_user_upload_settings.ACCOUNT_CREATION_EMAIL_SENDER_ADDRESS
+    email_subject = bulk_user_upload_settings.ACCOUNT_CREATION_EMAIL_SUBJECT
+    users_preprocessor_cls = bulk_user_upload_settings.USERS_PREPROCESSOR
+    users_creator_cls = bulk_user_upload_settings.USERS_CREATOR
+    email_sender_cls = bulk_user_upload_settings.EMAIL_SENDER
+    username_field = bulk_user_upload_settings.USERNAME_FIELD
+    email_field = bulk_user_upload_settings.EMAIL_FIELD
+    max_reported_issues = 100
+
+    def __init__(self, job: UploadJob):
+        self.job = job
+
+    @property
+    def users_creator(self):
+        return build_users_creator(self.users_creator_cls, self.username_field, self.users_preprocessor_cls)
+
+    @property
+    def email_sender(self):
+        return get_email_sender(
+            self.email_sender_cls,
+            username_field=self.username_field,
+            email_field=self.email_field,
+            concurrency=bulk_user_upload_settings.EMAIL_CONCURRENCY,
+            rate_limit=bulk_user_upload_settings.EMAIL_RATE_LIMIT,
+        )
+
+    @staticmethod
+    def get_email_recipient_name(user):
+        return bulk_user_upload_settings.GET_EMAIL_RECIPIENT_NAME(user)
+
+    def save_job(self, *fields):
+        self.job.save(update_fields=[*fields, "updated_at"])
+
+    def start_stage(self, stage):
+        self.job.stage = stage
+        self.save_job("stage")
+        return time.monotonic()
+
+    def finish_stage(self, stage, started, **results):
+        self.job.results[stage] = dict(seconds=round(time.monotonic() - started, 3), **results)
+        self.save_job("results")
+
+    def __call__(self):
+        tracer_cls = bulk_user_upload_settings.TRACER
+        if tracer_cls is None:
+            return self.process()
+        with tracing.activate(tracer_cls()):
+            return self.process()
+
+    def process(self):
+        form = self.validate()
+        if form is not None:
+            self.create(form)
+
+    def validate(self):
+        """Returns the bound upload form if the stored CSV is valid; otherwise records its issues and fails the job."""
+        job = self.job
+        started = self.start_stage("validation")
+        form = bulk_user_upload_settings.USER_UPLOAD_FORM(
+            data={"send_emails": job.send_emails}, files={"csv_file": job.csv_file}
+        )
+        is_valid = form.is_valid()
+        job.total_rows = form.row_count
+        self.save_job("total_rows")
+        errors = form.count_issues("errors")
+        warnings = form.count_issues("warnings")
+        self.finish_stage("validation", started, rows=form.row_count, errors=errors, warnings=warnings)
+        if is_valid:
+            return form
+        job.issues = get_upload_issues(form, self.max_reported_issues)
+        job.status = UploadJob.FAILED
+        job.error = get_upload_error(form)
+        # an invalid upload can't be retried, so it isn't kept in storage
+        job.csv_file.delete(save=False)
+        self.save_job("issues", "status", "error", "csv_file")
+        return None
+
+    def record_batch(self, result):
+        job = self.job
+        job.created_count += len(result.created)
+        job.skipped_count += len(result.skipped)
+        job.processed_rows += len(result.created) + len(result.skipped) + len(result.updated)
+        self.save_job("created_count", "skipped_count", "processed_rows")
+
+    def create(self, form):
+        job = self.job
+        started = self.start_stage("creation")
+        email_results = []
+
+        def email(created):
+            if job.send_emails:
+                email_results.append(send_account_emails(
+                    self.email_sender,
+                    self.email_template_name,
+                    job.login_url,
+                    self.email_sender_address,
+                    self.email_subject,
+                    self.get_email_recipient_name,
+                    created
+                ))
+
+        # every batch of a job is checkpointed, so that a failed job resumes where it stopped when it is run again
+        result = create_uploaded_users(
+            form, self.users_creator, f"job-{job.pk}", email=email, on_batch=self.record_batch, batched=True
+        )
+        email_seconds = sum(email_result.seconds for email_result in email_results)
+        job.results["creation"] = dict(
+            seconds=round(time.monotonic() - started - email_seconds, 3),
+            created=job.created_count,
+            updated=len(result.updated),
+            skipped=job.skipped_count,
+        )
+        if job.send_emails:
+            job.results["emails"] = dict(
+                seconds=round(email_seconds, 3),
+                sent=sum(email_result.sent for email_result in email_results),
+                failed=sum(email_result.failed for email_result in email_results),
+            )
+        job.status = UploadJob.SUCCEEDED
+        job.stage = ""
+        job.csv_file.delete(save=False)
+        self.save_job("results", "status", "stage", "csv_file")
+
+
+def process_upload_job(job_pk):
+    """
+    Claims and processes a pending upload job. Returns the processed job, or None if the job is no longer pending,
+    e.g. because another worker claimed it first.
+    """
+    if not UploadJob.objects.filter(pk=job_pk, status=UploadJob.PENDING).update(
+        status=UploadJob.RUNNING, updated_at=timezone.now()
+    ):
+        return None
+    job = UploadJob.objects.get(pk=job_pk)
+    try:
+        bulk_user_upload_settings.UPLOAD_JOB_PROCESSOR(job)()
+    except Exception as e:
+        message = f"Something went wrong while processing upload job {job_pk}: {e}"
+        logger.exception(message, exc_info=e)
+        job.status = UploadJob.FAILED
+        job.error = message
+        job.save(update_fields=["status", "error", "updated_at"])
+    return job
+
+
+def fail_stale_upload_jobs():
+    """
+    Fails the running jobs that have made no progress for `UPLOAD_JOB_STALE_TIMEOUT` seconds, e.g. because the process
+    running them died, so that they can be retried. Returns the number of jobs failed.
+    """
+    timeout = bulk_user_upload_settings.UPLOAD_JOB_STALE_TIMEOUT
+    if not timeout:
+        return 0
+    now = timezone.now()
+    return UploadJob.objects.filter(status=UploadJob.RUNNING, updated_at__lt=now - timedelta(seconds=timeout)).update(
+        status=UploadJob.FAILED, error=f"The upload job made no progress for {timeout} seconds.", updated_at=now
+    )
+
+
+def delete_expired_upload_files():
+    """
+    Deletes the stored files of failed jobs once they can no longer be resumed, `CREATION_CHECKPOINT_TIMEOUT` seconds
+    after they failed. Returns the number of files deleted.
+    """
+    expired_at = timezone.now() - timedelta(seconds=bulk_user_upload_settings.CREATION_CHECKPOINT_TIMEOUT)
+    jobs = UploadJob.objects.filter(status=UploadJob.FAILED, updated_at__lt=expired_at).exclude(csv_file="")
+    deleted = 0
+    for job in jobs:
+        job.csv_file.delete(save=False)
+        job.save(update_fields=["csv_file"])
+        deleted += 1
+    return deleted
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _process_in_thread(job_pk):
+    close_old_connections()
+    try:
+        process_upload_job(job_pk)
+    finally:
+        connections.close_all()
+
+
+def run_in_thread(job: UploadJob):
+    """Upload job runner that processes jobs in a pool of `UPLOAD_JOB_WORKERS` threads of the web process."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=bulk_user_upload_settings.UPLOAD_JOB_WORKERS, thread_name_prefix="bulk_user_upload"
+            )
+    return _executor.submit(_process_in_thread, job.pk)
+
+
+def leave_for_worker(job: UploadJob):
+    """Upload job runner that leaves jobs pending for the `process_upload_jobs` management command to pick up."""
@@ -0,0 +1,52 @@
+"""
+Lazily imported modules. pandas and numpy take a noticeable share of a Django process's startup time and memory, and the
+admin imports this package in every process, e.g. every web worker and management command; they are only loaded once
+an upload is actually processed.
+"""
+import importlib
+import importlib.util
+import sys
+import threading
+import types
+
+# serialises the first import of the lazy modules; importlib.util.LazyLoader is not thread-safe before Python 3.12
+_import_lock = threading.RLock()
+
+
+class LazyModule(types.ModuleType):
+    """Stands in for a module that is imported on first attribute access, and then forwards every access to it."""
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            with _import_lock:
+                module = self.__dict__["_module"]
+                if module is None:
+                    module = importlib.import_module(self.__name__)
+                    self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        return f"<lazy module {self.__name__!r}>"
+
+
+def lazy_import(name):
+    """
+    Returns module `name`, which is only imported when one of its attributes is first accessed; an import of it by
+    then, e.g. by another module, is used as is. Raises ImportError right away if the module is not installed.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name) is None:
+        raise ImportError(f"No module named {name!r}", name=name)
+    return LazyModule(name)
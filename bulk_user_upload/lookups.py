@@ -0,0 +1,89 @@
+"""
+Group and permission lookup maps, cached so that uploads don't query them again and again. The maps are kept in process
+memory, or in the Django cache named by the LOOKUP_CACHE setting so that all processes share them, for
+LOOKUP_CACHE_TIMEOUT seconds. They are also cleared whenever a Group, Permission or ContentType is saved or deleted, or
+migrations are run, in the process that does so.
+"""
+import hashlib
+import time
+
+from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_migrate, post_save
+
+from bulk_user_upload.settings import bulk_user_upload_settings
+
+cache_key_prefix = "bulk_user_upload:lookup:"
+_lookup_maps = {}
+
+
+def load_groups_map():
+    return {g["name"]: g["id"] for g in Group.objects.values('id', 'name')}
+
+
+def load_perms_map():
+    return {
+        f"{v['content_type__app_label']}.{v['codename']}": v["id"] for v in
+        Permission.objects.values('id', 'content_type__app_label', 'codename')
+    }
+
+
+loaders = {
+    "groups": load_groups_map,
+    "perms": load_perms_map,
+}
+
+
+def get_lookup_map(name):
+    alias = bulk_user_upload_settings.LOOKUP_CACHE
+    timeout = bulk_user_upload_settings.LOOKUP_CACHE_TIMEOUT
+    if alias:
+        cache = caches[alias]
+        lookup_map = cache.get(f"{cache_key_prefix}{name}")
+        if lookup_map is None:
+            lookup_map = loaders[name]()
+            cache.set(f"{cache_key_prefix}{name}", lookup_map, timeout)
+        return lookup_map
+    now = time.monotonic()
+    if name not in _lookup_maps or (timeout is not None and now - _lookup_maps[name][0] >= timeout):
+        _lookup_maps[name] = (now, loaders[name]())
+    return _lookup_maps[name][1]
+
+
+def get_groups_map():
+    return get_lookup_map("groups")
+
+
+def get_perms_map():
+    return get_lookup_map("perms")
+
+
+def get_lookup_version():
+    """A short hash of the group and permission lookup maps, which changes whenever a group or permission does."""
+    maps = [sorted(get_lookup_map(name).items()) for name in loaders]
+    return hashlib.sha256(repr(maps).encode("utf-8")).hexdigest()[:16]
+
+
+def clear_lookup_maps(*args, **kwargs):
+    _lookup_maps.clear()
+    alias = bulk_user_upload_settings.LOOKUP_CACHE
+    if alias:
+        caches[alias].delete_many([f"{cache_key_prefix}{name}" for name in loaders])
+
+
+def invalidate_lookup_maps(*args, **kwargs):
+    clear_lookup_maps()
+    # maps loaded before the change is committed would otherwise miss it
+    transaction.on_commit(clear_lookup_maps)
+
+
+def connect_signals():
+    for model in (Group, Permission, ContentType):
+        post_save.connect(invalidate_lookup_maps, sender=model, dispatch_uid=f"bulk_user_upload_{model.__name__}_saved")
+        post_delete.connect(
+            invalidate_lookup_maps, sender=model, dispatch_uid=f"bulk_user_upload_{model.__name__}_deleted"
+        )
+    # permissions and content types are created in bulk, without post_save signals, when migrations run
+    post_migrate.connect(clear_lookup_maps, dispatch_uid="bulk_user_upload_migrated")
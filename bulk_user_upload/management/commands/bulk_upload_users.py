@@ -0,0 +1,163 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from django.core.files.uploadedfile import UploadedFile
+from django.core.management.base import BaseCommand, CommandError
+
+from bulk_user_upload import tracing
+from bulk_user_upload.jobs import build_users_creator, create_uploaded_users, get_upload_error, get_upload_issues
+from bulk_user_upload.settings import bulk_user_upload_settings
+from bulk_user_upload.utils import get_email_sender, send_account_emails
+
+
+class Command(BaseCommand):
+    help = (
+        "Validates and creates users from a CSV file, or from stdin, outside of the admin; e.g. for scheduled syncs. "
+        "The upload is read in chunks and is not subject to MAX_UPLOAD_ROWS."
+    )
+    email_template_name = "email/account_creation_email.html"
+
+    def add_arguments(self, parser):
+        parser.add_argument("csv_file", help="Path of the CSV file to upload, or - to read it from stdin.")
+        parser.add_argument("--validate-only", action="store_true", help="Validate the upload without creating users.")
+        parser.add_argument(
+            "--batch-size", type=int,
+            help="Commit every BATCH_SIZE created users in their own transaction, resuming after the last committed "
+                 "batch if the same file is uploaded again after a failure (default: CREATION_BATCH_SIZE).",
+        )
+        parser.add_argument(
+            "--workers", type=int,
+            help="Number of processes validating the upload, and of email backend connections sending emails, in "
+                 "parallel (default: VALIDATION_WORKERS and EMAIL_CONCURRENCY).",
+        )
+        parser.add_argument("--send-emails", action="store_true", help="Email the created users.")
+        parser.add_argument(
+            "--force", action="store_true",
+            help="Create the users even if the same file was uploaded within UPLOAD_CACHE_TIMEOUT seconds.",
+        )
+        parser.add_argument(
+            "--login-url", default=bulk_user_upload_settings.LOGIN_URL,
+            help="Login URL used in the account creation emails (default: LOGIN_URL).",
+        )
+        parser.add_argument("--json", action="store_true", dest="as_json", help="Write the summary as JSON.")
+
+    def handle(self, *args, csv_file=None, validate_only=False, batch_size=None, workers=None, send_emails=False,
+               force=False, login_url=None, as_json=False, **options):
+        tracer_cls = bulk_user_upload_settings.TRACER
+        tracer = tracer_cls() if tracer_cls else None
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = self.get_path(csv_file, temp_dir)
+            with open(path, "rb") as f:
+                upload = UploadedFile(
+                    file=f, name=os.path.basename(path), content_type="text/csv", size=os.path.getsize(path)
+                )
+                arguments = (upload, validate_only, batch_size, workers, send_emails, force, login_url)
+                if tracer is None:
+                    summary = self.upload(*arguments)
+                else:
+                    with tracing.activate(tracer):
+                        summary = self.upload(*arguments)
+                    summary["stages"] = tracer.summary()
+
+        self.write_summary(summary, as_json)
+        if not summary["valid"]:
+            raise CommandError(summary["error"])
+
+    @staticmethod
+    def get_path(csv_file, temp_dir):
+        """Returns the path of the CSV file to upload, copying stdin to a temporary file if `csv_file` is "-"."""
+        if csv_file != "-":
+            if not os.path.isfile(csv_file):
+                raise CommandError(f"{csv_file} is not a file.")
+            return csv_file
+        path = os.path.join(temp_dir, "stdin.csv")
+        with open(path, "wb") as f:
+            shutil.copyfileobj(sys.stdin.buffer, f)
+        return path
+
+    def upload(self, upload, validate_only, batch_size, workers, send_emails, force, login_url):
+        form = bulk_user_upload_settings.USER_UPLOAD_FORM(
+            data={"send_emails": send_emails, "force": force}, files={"csv_file": upload}
+        )
+        form.limit_rows = False
+        form.validation_workers = workers
+        is_valid = form.is_valid(validate_only)
+        errors = form.count_issues("errors")
+        warnings = form.count_issues("warnings")
+        summary = dict(
+            valid=is_valid,
+            rows=form.row_count,
+            errors=errors,
+            warnings=warnings,
+            issues=get_upload_issues(form),
+        )
+        if not is_valid:
+            summary["error"] = get_upload_error(form)
+            return summary
+        if validate_only:
+            return summary
+        previous_run = form.get_previous_run()
+        if previous_run is not None:
+            summary["duplicate_of"] = dict(previous_run, finished_at=previous_run["finished_at"].isoformat())
+            return summary
+
+        email_sender = get_email_sender(
+            bulk_user_upload_settings.EMAIL_SENDER,
+            username_field=bulk_user_upload_settings.USERNAME_FIELD,
+            email_field=bulk_user_upload_settings.EMAIL_FIELD,
+            concurrency=workers or bulk_user_upload_settings.EMAIL_CONCURRENCY,
+            rate_limit=bulk_user_upload_settings.EMAIL_RATE_LIMIT,
+        )
+        summary.update(created=0, updated=0, skipped=0)
+        if send_emails:
+            summary.update(emails_sent=0, emails_failed=0)
+
+        def email(created):
+            if not send_emails:
+                return
+            sent, failed, seconds = send_account_emails(
+                email_sender,
+                self.email_template_name,
+                login_url,
+                bulk_user_upload_settings.ACCOUNT_CREATION_EMAIL_SENDER_ADDRESS,
+                bulk_user_upload_settings.ACCOUNT_CREATION_EMAIL_SUBJECT,
+                bulk_user_upload_settings.GET_EMAIL_RECIPIENT_NAME,
+                created,
+            )
+            summary["emails_sent"] += sent
+            summary["emails_failed"] += failed
+
+        result = create_uploaded_users(form, build_users_creator(batch_size=batch_size), form.content_hash, email=email)
+        summary.update(created=len(result.created), updated=len(result.updated), skipped=len(result.skipped))
+        return summary
+
+    def write_summary(self, summary, as_json=False):
+        if as_json:
+            self.stdout.write(json.dumps(summary, indent=2))
+            return
+        self.stdout.write(
+            f"{summary['rows']} rows: {summary['errors']} with errors, {summary['warnings']} with warnings."
+        )
+        for issue in summary["issues"]:
+            self.stdout.write(f"  row {issue['row']}: {'; '.join(filter(None, [issue['errors'], issue['warnings']]))}")
+        if "duplicate_of" in summary:
+            previous_run = summary["duplicate_of"]
+            self.stdout.write(
+                f"This file was already uploaded at {previous_run['finished_at']}, when {previous_run['created']} users "
+                f"were created and {previous_run['updated']} updated; it was not processed again. Pass --force to "
+                "process it anyway."
+            )
+        if "created" in summary:
+            self.stdout.write(
+                f"{summary['created']} users created, {summary['updated']} updated, {summary['skipped']} skipped."
+            )
+        if "emails_sent" in summary:
+            self.stdout.write(f"{summary['emails_sent']} emails sent, {summary['emails_failed']} failed.")
+        for stage in summary.get("stages", []):
+            self.stdout.write(
+                f"  {stage['name']}: {stage['seconds']:.3f}s, {stage['queries']} queries"
+                + (f", {stage['rows']} rows" if stage["rows"] is not None else "")
+            )
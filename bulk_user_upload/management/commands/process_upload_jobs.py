@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from bulk_user_upload.jobs import delete_expired_upload_files, fail_stale_upload_jobs, process_upload_job
+from bulk_user_upload.models import UploadJob
+
+
+class Command(BaseCommand):
+    help = "Processes pending bulk user upload jobs, polling the database for new ones."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Process the currently pending jobs, then exit.")
+        parser.add_argument(
+            "--interval", type=float, default=5, help="Seconds to wait between polls for pending jobs (default: 5)."
+        )
+        parser.add_argument(
+            "--retry", type=int, metavar="JOB_ID",
+            help=(
+                "Mark a failed job, or a running job that went UPLOAD_JOB_STALE_TIMEOUT seconds without progress, as "
+                "pending again, so that it resumes after its last committed batch."
+            ),
+        )
+
+    def handle(self, *args, once=False, interval=5, retry=None, **options):
+        self.fail_stale_jobs()
+        if retry is not None:
+            if not UploadJob.objects.filter(pk=retry, status=UploadJob.FAILED).exclude(csv_file="").update(
+                status=UploadJob.PENDING, error="", updated_at=timezone.now()
+            ):
+                raise CommandError(f"Upload job {retry} does not exist, has not failed or has no stored upload.")
+        while True:
+            for job_pk in UploadJob.objects.filter(status=UploadJob.PENDING).order_by("created_at").values_list(
+                "pk", flat=True
+            ):
+                job = process_upload_job(job_pk)
+                if job is not None:
+                    self.stdout.write(f"{job}: {job.created_count} users created, {job.skipped_count} skipped.")
+            self.fail_stale_jobs()
+            delete_expired_upload_files()
+            if once:
+                return
+            time.sleep(interval)
+
+    def fail_stale_jobs(self):
+        failed = fail_stale_upload_jobs()
+        if failed:
+            self.stderr.write(f"{failed} upload jobs made no progress for too long and were marked as failed.")
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 05:14
+
+import bulk_user_upload.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bulk_user_upload', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uploadjob',
+            name='csv_file',
+            field=models.FileField(blank=True, upload_to=bulk_user_upload.models.upload_job_file_name),
+        ),
+    ]
@@ -0,0 +1,56 @@
+import uuid
+
+from django.conf import settings
+from django.db import models
+
+
+def upload_job_file_name(job, filename):
+    """A random name to store an upload under, so that it can't be guessed from the name of the uploaded file."""
+    return f"bulk_user_upload/{uuid.uuid4().hex}.csv"
+
+
+class UploadJob(models.Model):
+    """An uploaded CSV that is validated, created and emailed in the background, outside of the admin request."""
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (SUCCEEDED, "Succeeded"),
+        (FAILED, "Failed"),
+    ]
+
+    csv_file = models.FileField(upload_to=upload_job_file_name, blank=True)
+    send_emails = models.BooleanField(default=False)
+    login_url = models.CharField(max_length=2048, blank=True)  # used in account creation notification email template
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    stage = models.CharField(max_length=32, blank=True)  # the stage currently being processed
+    total_rows = models.PositiveIntegerField(null=True, blank=True)
+    processed_rows = models.PositiveIntegerField(default=0)
+    created_count = models.PositiveIntegerField(default=0)
+    skipped_count = models.PositiveIntegerField(default=0)
+    results = models.JSONField(default=dict, blank=True)  # stage name -> results of that stage, e.g. timing and counts
+    issues = models.JSONField(default=list, blank=True)  # rows that failed validation
+    error = models.TextField(blank=True)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"Upload job {self.pk} ({self.status})"
+
+    @property
+    def is_finished(self):
+        return self.status in (self.SUCCEEDED, self.FAILED)
+
+    @property
+    def progress(self):
+        """Percentage of rows processed, or None while the number of rows is unknown."""
+        if not self.total_rows:
+            return None
+        return round(100 * self.processed_rows / self.total_rows)
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import io
+import logging
+import re
+import uuid
+from datetime import timedelta
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from bulk_user_upload.lazy import lazy_import
+from bulk_user_upload.settings import bulk_user_upload_settings
+
+pandas = lazy_import("pandas")
+
+logger = logging.getLogger(__file__)
+
+report_id_regex = re.compile(r"^[0-9a-f]{32}$")
+
+
+def issue_type(message):
+    """
+    Generalizes an issue message into its type by masking the uploaded values it quotes, e.g. "email='a@b' is invalid."
+    becomes "email='…' is invalid.", and the list of invalid items that group and permission messages start with.
+    """
+    message = re.sub(r"'[^']*'", "'…'", message)
+    return re.sub(r"^.+ (are not valid (group|permission) names)", r"… \1", message)
+
+
+def summarize_issues(messages: pandas.Series):
+    """Counts the rows with each type of issue in a column of "; "-joined issue messages, most common first."""
+    messages = messages[messages != ""]
+    if messages.empty:
+        return []
+    types = messages.str.split("; ").explode().map(issue_type)
+    # a row with the same type of issue twice, e.g. in two columns, counts once for that type
+    types = pandas.DataFrame({"row": types.index, "type": types.values}).drop_duplicates()
+    return list(types["type"].value_counts().items())
+
+
+class IssueReport:
+    """
+    The annotated rows of an upload that has issues: the row number, errors, warnings and uploaded columns of every
+    flagged row. Reports are stored as CSV in the default storage, so that the admin can page through them and download
+    them after the upload request; they are deleted once they are older than `ISSUE_REPORT_TIMEOUT` seconds.
+    """
+    location = "bulk_user_upload/reports/"
+
+    def __init__(self, report_id):
+        if not report_id_regex.match(report_id or ""):
+            raise ValueError(f"Invalid issue report id {report_id!r}")
+        self.report_id = report_id
+
+    @property
+    def path(self):
+        return f"{self.location}{self.report_id}.csv"
+
+    @classmethod
+    def save(cls, rows: pandas.DataFrame):
+        cls.prune()
+        report = cls(uuid.uuid4().hex)
+        annotations = [column for column in ("row", "errors", "warnings") if column in rows]
+        rows = rows[annotations + [column for column in rows if column not in annotations]]
+        default_storage.save(report.path, ContentFile(rows.to_csv(index=False).encode("utf-8")))
+        return report
+
+    @classmethod
+    def prune(cls):
+        """Deletes the reports that have expired."""
+        expired = timezone.now() - timedelta(seconds=bulk_user_upload_settings.ISSUE_REPORT_TIMEOUT)
+        try:
+            _, file_names = default_storage.listdir(cls.location)
+            for file_name in file_names:
+                path = f"{cls.location}{file_name}"
+                if default_storage.get_modified_time(path) < expired:
+                    default_storage.delete(path)
+        except (FileNotFoundError, NotImplementedError):
+            return
+        except Exception as e:
+            logger.exception(f"Something went wrong while deleting expired issue reports: {e}", exc_info=e)
+
+    def exists(self):
+        return default_storage.exists(self.path)
+
+    def open(self):
+        return default_storage.open(self.path, "rb")
+
+    def load(self) -> pandas.DataFrame:
+        with self.open() as f:
+            return pandas.read_csv(f, dtype=str, keep_default_na=False)
+
+    def to_xlsx(self) -> bytes:
+        """The report as an Excel workbook; requires openpyxl."""
+        output = io.BytesIO()
+        self.load().to_excel(output, index=False, engine="openpyxl")
+        return output.getvalue()
@@ -19,6 +19,8 @@ Redistribution and use in source and binary forms, with or without modification,
     Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote products derived from this software without specific prior written permission.
 THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
+import hashlib
+
 from django.conf import settings
 from django.test.signals import setting_changed
 from django.utils.module_loading import import_string
@@ -36,8 +38,51 @@ DEFAULTS = {
     'ACCOUNT_CREATION_EMAIL_SENDER_ADDRESS': None,  # email address used to notify user of account creation
     'ACCOUNT_CREATION_EMAIL_SUBJECT': 'Account Created',
     'EMAIL_SENDER': 'bulk_user_upload.utils.EmailSender',  # sends emails to created accounts
+    'EMAIL_CONCURRENCY': 1,  # number of email backend connections used in parallel to send account creation emails
+    'EMAIL_RATE_LIMIT': None,  # maximum number of account creation emails sent per second; None for no limit
     # compute the name of the recipient, used in the account creation notification email template
     'GET_EMAIL_RECIPIENT_NAME': 'bulk_user_upload.utils.get_email_recipient_name',
+    'MAX_UPLOAD_ROWS': None,  # maximum number of rows accepted per upload; None for no limit
+    'ISSUE_REPORT_TIMEOUT': 60 * 60 * 24,  # seconds the stored issue reports of uploads can be paged and downloaded for
+    'UPLOAD_CHUNK_SIZE': 5000,  # number of CSV rows read, validated and created at a time
+    'CSV_ENGINE': 'c',  # pandas CSV parser: 'c', 'python', or 'pyarrow' to stream uploads with pyarrow if it is installed
+    # low-cardinality columns read as categoricals rather than strings
+    'CATEGORICAL_COLUMNS': ['groups', 'permissions', 'is_staff'],
+    # engine uploads are processed with: 'pandas', 'csv' for the csv module and plain Python lists, 'polars' if it is
+    # installed, or 'auto' for 'csv' up to SMALL_UPLOAD_SIZE bytes, 'polars' (if installed) above LARGE_UPLOAD_SIZE
+    # bytes and 'pandas' in between; see bulk_user_upload.engines
+    'UPLOAD_ENGINE': 'pandas',
+    'SMALL_UPLOAD_SIZE': 1024 * 1024,
+    'LARGE_UPLOAD_SIZE': 64 * 1024 * 1024,
+    # number of processes validating shards of each chunk with the field and check_row_ validators; needs fork and
+    # the main thread
+    'VALIDATION_WORKERS': 1,
+    # alias of a Django cache in which to share group and permission lookups between processes; None keeps them in
+    # process memory
+    'LOOKUP_CACHE': None,
+    # seconds group and permission lookups are cached for, so that changes the signals of this process miss, e.g. those
+    # saved by other processes or in bulk, are picked up; None caches them until a change is signalled
+    'LOOKUP_CACHE_TIMEOUT': 60,
+    # commit every CREATION_BATCH_SIZE created users in their own transaction; None creates all users in one transaction
+    'CREATION_BATCH_SIZE': None,
+    'CREATION_CHECKPOINT_TIMEOUT': 60 * 60 * 24 * 7,  # seconds a failed batched upload can be resumed for
+    # seconds the validation of a valid upload and its completed run are cached for by its content, so that submitting
+    # a file that was just validated only runs the database checks again, and submitting it again is refused as a
+    # duplicate run; 0 disables the cache
+    'UPLOAD_CACHE_TIMEOUT': 60 * 60,
+    # update the fields, groups and permissions of existing users that differ from the upload, instead of skipping them
+    'UPDATE_EXISTING_USERS': False,
+    'ASYNC_UPLOADS': False,  # validate and create submitted uploads in a background job
+    # starts processing a newly submitted UploadJob; use 'bulk_user_upload.jobs.leave_for_worker' to leave jobs for the
+    # process_upload_jobs management command instead
+    'UPLOAD_JOB_RUNNER': 'bulk_user_upload.jobs.run_in_thread',
+    'UPLOAD_JOB_WORKERS': 1,  # number of threads processing upload jobs with the run_in_thread runner
+    'UPLOAD_JOB_PROCESSOR': 'bulk_user_upload.jobs.UploadJobProcessor',  # runs the upload pipeline for an UploadJob
+    # seconds a running upload job can go without progress before it is presumed dead and failed, so it can be retried;
+    # None never fails running jobs
+    'UPLOAD_JOB_STALE_TIMEOUT': 60 * 60,
+    # records the timed spans of each upload and sends the span_finished signal; None disables tracing
+    'TRACER': 'bulk_user_upload.tracing.Tracer',
 }
 
 
@@ -50,6 +95,9 @@ IMPORT_STRINGS = [
     'USER_FIELD_VALIDATORS',
     'GET_EMAIL_RECIPIENT_NAME',
     'EMAIL_SENDER',
+    'UPLOAD_JOB_RUNNER',
+    'UPLOAD_JOB_PROCESSOR',
+    'TRACER',
 ]
 
 
@@ -57,6 +105,20 @@ IMPORT_STRINGS = [
 REMOVED_SETTINGS = []
 
 
+def describe_setting(val):
+    """
+    A representation of a setting's value that is the same in every process, identifying imported classes and functions
+    by their import path.
+    """
+    if isinstance(val, dict):
+        return "{%s}" % ", ".join(f"{key!r}: {describe_setting(item)}" for key, item in sorted(val.items(), key=str))
+    elif isinstance(val, (list, tuple)):
+        return "[%s]" % ", ".join(describe_setting(item) for item in val)
+    elif callable(val):
+        return f"{getattr(val, '__module__', '')}.{getattr(val, '__qualname__', type(val).__qualname__)}"
+    return repr(val)
+
+
 def perform_import(val, setting_name):
     """
     If the given setting is a string import notation,
@@ -128,6 +190,11 @@ class Settings:
         setattr(self, attr, val)
         return val
 
+    def get_version(self):
+        """A short hash of all settings, which changes whenever one of them does."""
+        values = {attr: self.user_settings.get(attr, default) for attr, default in self.defaults.items()}
+        return hashlib.sha256(describe_setting(values).encode("utf-8")).hexdigest()[:16]
+
     def reload(self):
         for attr in self._cached_attrs:
             delattr(self, attr)
@@ -0,0 +1,89 @@
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import connection
+from django.dispatch import Signal
+
+# sent by Tracer with the finished `span` and the `tracer` that recorded it
+span_finished = Signal()
+
+span_tuple = namedtuple("span", ["name", "seconds", "rows", "queries"])
+
+_active_tracer = ContextVar("bulk_user_upload_tracer", default=None)
+
+
+class QueryCounter:
+    """Database execute wrapper that counts the queries run through it."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Tracer:
+    """
+    Records the named spans of an upload, e.g. "parse", "validation.check_frame_duplicates" or "creation.insert", with
+    their duration, row count and query count, and sends the `span_finished` signal for each of them. Point the
+    `TRACER` setting at a subclass to forward spans elsewhere, e.g. to an APM client.
+    """
+
+    def __init__(self):
+        self.spans = []
+
+    @contextmanager
+    def span(self, name, rows=None):
+        """Times the block as span `name`; the block may set the span's row count through the yielded dict."""
+        details = dict(rows=rows)
+        counter = QueryCounter()
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(counter):
+                yield details
+        finally:
+            self.finish(span_tuple(name, time.perf_counter() - started, details["rows"], counter.count))
+
+    def finish(self, span):
+        self.spans.append(span)
+        span_finished.send(sender=self.__class__, tracer=self, span=span)
+
+    def summary(self):
+        """Totals of the recorded spans by name, e.g. one entry per stage, in the order the names first finished."""
+        totals = {}
+        for span in self.spans:
+            total = totals.setdefault(span.name, dict(name=span.name, calls=0, seconds=0, rows=None, queries=0))
+            total["calls"] += 1
+            total["seconds"] += span.seconds
+            total["queries"] += span.queries
+            if span.rows is not None:
+                total["rows"] = (total["rows"] or 0) + span.rows
+        return list(totals.values())
+
+
+@contextmanager
+def activate(tracer):
+    """Makes `tracer` record the spans of the pipeline run within the block."""
+    token = _active_tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _active_tracer.reset(token)
+
+
+def get_active_tracer():
+    return _active_tracer.get()
+
+
+@contextmanager
+def span(name, rows=None):
+    """Times the block as span `name` of the active tracer, if any; see `Tracer.span`."""
+    tracer = _active_tracer.get()
+    if tracer is None:
+        yield dict(rows=rows)
+    else:
+        with tracer.span(name, rows) as details:
+            yield details
@@ -1,38 +1,177 @@
+from __future__ import annotations
+
+import inspect
+import logging
+import multiprocessing
+import os
 import re
+import threading
+import time
 from collections import namedtuple
-from typing import List
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right
+from typing import Iterable, List
 
 from django.contrib.auth import get_user_model
-from django.contrib.auth.models import Group, Permission
-from django.core.mail import send_mass_mail
-from django.db.models import Q
-
-import pandas
-from django.template.loader import render_to_string
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
+from django.db import connections, transaction
+from django.db.models import UniqueConstraint
+from django.template import Context, Template, engines
+from django.template.backends.django import DjangoTemplates
+from django.template.loader import get_template
+from django.test.signals import setting_changed
+from django.utils import timezone
 from django.utils.functional import partition
 
+from bulk_user_upload import tracing
+from bulk_user_upload.engines import engine_of
+from bulk_user_upload.lazy import lazy_import
+from bulk_user_upload.lookups import get_groups_map, get_lookup_version, get_perms_map
+from bulk_user_upload.settings import bulk_user_upload_settings
+
+# only loaded once an upload is processed; see bulk_user_upload.lazy
+numpy = lazy_import("numpy")
+pandas = lazy_import("pandas")
+
 User = get_user_model()
 
+logger = logging.getLogger(__file__)
+
 email_regex = re.compile(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)")
 username_regex = re.compile(r"^([a-zA-Z_0-9]{3,})$")
 
 
-def get_groups_map():
-    return {g["name"]: g["id"] for g in Group.objects.values('id', 'name')}
+# A field validator that checks a whole column at once. `is_invalid` receives a column of the upload's engine, e.g. a
+# pandas.Series, and returns a column aligned with it: either a boolean mask of the invalid rows, or a column whose
+# truthy entries mark the invalid rows and are passed on to `message_builder(value, invalid)`, which is only called for
+# the rows that failed. Checks built on the operations of `engine_of(column)` work with every engine.
+column_validator = namedtuple("column_validator", ["is_invalid", "message_builder"])
+
+
+def as_column_validator(validator) -> column_validator:
+    """Adapts a scalar `(is_invalid, message_builder)` field validator so that it can be run against a whole column."""
+    if isinstance(validator, column_validator):
+        return validator
+    is_invalid, message_builder = validator
+
+    def is_invalid_column(column):
+        return engine_of(column).map(column, is_invalid)
+    return column_validator(is_invalid_column, message_builder)
+
+
+def regex_mismatch(regex):
+    """Column check flagging every value that does not match `regex`."""
+    def is_invalid(column):
+        return engine_of(column).mismatches(column, regex)
+    return is_invalid
+
+
+def not_in(values):
+    """Column check flagging every value that is not one of `values`."""
+    return lambda column: engine_of(column).not_in(column, values)
+
+
+def invalid_list_items(valid_items):
+    """
+    Column check for comma-separated lists, e.g. of group names; each invalid row is mapped to the list of its items
+    that are not in `valid_items`.
+    """
+    def is_invalid(column):
+        engine = engine_of(column)
+        rows, items = engine.split_lists(column)
+        invalid = [(row, item) for row, item in zip(rows, items) if item not in valid_items]
+        return engine.collect_by_row(column, [row for row, _ in invalid], [item for _, item in invalid])
+    return is_invalid
+
+
+class MembershipTable:
+    """
+    Long-format table of the memberships listed in an upload's comma-separated list columns, e.g. groups and
+    permissions: one (row, id) pair per valid item, kept per column. It is filled in once, while the upload is
+    validated, and reused to assign the memberships when the users are created. The pairs are plain lists, whichever
+    engine the upload is read with.
+    """
+
+    def __init__(self):
+        # column name -> list of (rows, ids) pairs of lists, one per parsed chunk, in row order
+        self.tables = {}
+
+    def __contains__(self, column_name):
+        return column_name in self.tables
+
+    def add(self, column_name, column, lookup_map):
+        """
+        Parses `column` and records the ids of its items that are in `lookup_map`. Returns every parsed item as three
+        lists: the rows, the items and their ids, which are None for the items that are not in `lookup_map`.
+        """
+        rows, items = engine_of(column).split_lists(column)
+        ids = [lookup_map.get(item) for item in items]
+        valid = [(row, id) for row, id in zip(rows, ids) if id is not None]
+        self.tables.setdefault(column_name, []).append(([row for row, _ in valid], [id for _, id in valid]))
+        return rows, items, ids
+
+    def ids_by_row(self, column_name, index) -> dict:
+        """Maps each row of `index` that lists any valid item in `column_name` to the ids of those items."""
+        wanted = set(index)
+        if not wanted:
+            return {}
+        first, last = min(wanted), max(wanted)
+        ids_by_row = {}
+        for rows, ids in self.tables.get(column_name, []):
+            # the rows of a chunk are sorted, so the ones in range are found by bisection
+            start, stop = bisect_left(rows, first), bisect_right(rows, last)
+            for row, id in zip(rows[start:stop], ids[start:stop]):
+                if row in wanted:
+                    ids_by_row.setdefault(row, []).append(id)
+        return ids_by_row
+
+
+def invalid_memberships(field_validator, column_name, lookup_map):
+    """
+    Column check for a comma-separated list column, e.g. groups, that records the column's valid items in the
+    `memberships` table of `field_validator`; each invalid row is mapped to the list of its items not in `lookup_map`.
+    """
+    def is_invalid(column):
+        rows, items, ids = field_validator.memberships.add(column_name, column, lookup_map)
+        invalid = [(row, item) for row, item, id in zip(rows, items, ids) if id is None]
+        return engine_of(column).collect_by_row(column, [row for row, _ in invalid], [item for _, item in invalid])
+    return is_invalid
+
+
+def filter_in_chunks(queryset, field_name, values):
+    """
+    Yields the objects of `queryset` whose `field_name` is one of `values`, running one `__in` query per chunk of values
+    so that no query exceeds the database backend's limit on query parameters.
+    """
+    values = list(values)
+    connection = connections[queryset.db]
+    batch_size = connection.ops.bulk_batch_size([queryset.model._meta.get_field(field_name)], values) or 1
+    for start in range(0, len(values), batch_size):
+        yield from queryset.filter(**{f"{field_name}__in": values[start:start + batch_size]})
+
 
+# joins the values of several columns into one, so that they can be compared as one value; the ASCII unit separator
+# doesn't appear in uploaded values
+joined_values_separator = "\x1f"
 
-def get_perms_map():
-    return {
-        f"{v['content_type__app_label']}.{v['codename']}": v["id"] for v in
-        Permission.objects.values('id', 'content_type__app_label', 'codename')
-    }
+
+def load_existing_values(field_name, values, fields) -> List[tuple]:
+    """
+    The `fields` of the users whose `field_name` is one of the non-blank `values`, as a tuple per user. The users are
+    fetched with `filter_in_chunks`, so the number of queries grows with the number of values while each query stays
+    within the backend's limits, and uploaded rows can be compared to them in memory.
+    """
+    values = [value for value in dict.fromkeys(values) if value != ""]
+    return list(filter_in_chunks(User.objects.values_list(*fields), field_name, values))
 
 
 class FieldValidator(dict):
-    # field_name = (validator, custom_error_message)
-    email = (lambda x: not x or not email_regex.match(x), None)
-    username = (
-        lambda x: not x or not username_regex.match(x),
+    # field_name = (validator, custom_error_message), or column_validator(column_validator, custom_error_message)
+    email = column_validator(regex_mismatch(email_regex), None)
+    username = column_validator(
+        regex_mismatch(username_regex),
         lambda username, *args: f"username must consist of 3 or more alphanumeric characters or underscores"
     )
 
@@ -44,43 +183,26 @@ class FieldValidator(dict):
         if not self._groups:
             self._groups = get_groups_map()
 
-        def validate_groups(group_list_string):
-            invalid = []
-
-            for group in group_list_string.split(','):
-                group = group.strip()
-                if group and group not in self._groups:
-                    invalid.append(group)
-            return invalid
-
         def invalid_info(group_list_string, invalid):
             message = f"{','.join(invalid)} are not valid group names."
             return message
 
-        return validate_groups, invalid_info
+        return column_validator(invalid_memberships(self, "groups", self._groups), invalid_info)
 
     @property
     def permissions(self):
         if not self._permissions:
             self._permissions = get_perms_map()
 
-        def validate_permissions(permissions_list_string):
-            invalid = []
-
-            for perm in permissions_list_string.split(','):
-                perm = perm.strip()
-                if perm and perm not in self._permissions:
-                    invalid.append(perm)
-            return invalid
-
         def invalid_info(permissions_list_string, invalid):
             message = f"{','.join(invalid)} are not valid permission names; expecting format app_label.codename, e.g. {next(iter(self._permissions))}"
             return message
 
-        return validate_permissions, invalid_info
+        return column_validator(invalid_memberships(self, "permissions", self._permissions), invalid_info)
 
     def __init__(self, username_field=None, email_field=None, **kwargs):
         super().__init__()
+        self.memberships = MembershipTable()
         username_field = username_field if username_field else "username"
         email_field = email_field if email_field else "email"
         if kwargs.get(email_field, True):
@@ -99,16 +221,151 @@ class FieldValidator(dict):
 
 
 def append_or_create(dict_obj, key, value):
+    if isinstance(dict_obj, IssueList):
+        return dict_obj.add_message(key, value)
     if key in dict_obj:
         return dict_obj[key].append(value)
     dict_obj[key] = [value]
 
 
+# the rows flagged by one rule in one chunk: `rows` holds their row indexes, `values` the values the rule's message is
+# built from (or the messages themselves, if the rule has no renderer) and `details` any extra detail per row
+issue_block = namedtuple("issue_block", ["code", "rows", "values", "details"])
+
+
+class IssueList:
+    """
+    The errors or warnings of an upload, stored by column: one issue_block of row indexes and values per rule and chunk,
+    rather than a list of message strings per row. Messages are only built, by the renderer registered for the block's
+    rule code, when the rows they are reported for are rendered.
+
+    Reads like the dict of row index -> list of messages it replaces: iterating yields the flagged rows, `idx in issues`
+    tells whether a row is flagged and `issues[idx]` returns its messages.
+    """
+
+    def __init__(self):
+        self.blocks = []
+        # rule code -> callable(value, detail) building the rule's message
+        self.renderers = {}
+        self._pending_rows = []
+        self._pending_messages = []
+        self._rows = None
+
+    def add(self, code, rows, values, details=None, renderer=None):
+        """Flags `rows` for rule `code`, whose messages `renderer` builds from `values` and `details` when rendered."""
+        if renderer is not None:
+            self.renderers[code] = renderer
+        if not len(rows):
+            return
+        self._flush()
+        self._append_block(code, rows, values, details)
+        self._rows = None
+
+    def _append_block(self, code, rows, values, details=None):
+        rows = numpy.asarray(rows, dtype="int64")
+        # blocks are kept sorted by row so that rendering can find the rows of a chunk by bisection
+        order = numpy.argsort(rows, kind="stable")
+        self.blocks.append(issue_block(
+            code,
+            rows[order],
+            numpy.asarray(values, dtype=object)[order],
+            None if details is None else numpy.asarray(details, dtype=object)[order],
+        ))
+
+    def add_message(self, idx, message):
+        """Flags row `idx` with a message that is already built, e.g. by a check_row_ validator."""
+        self._pending_rows.append(idx)
+        self._pending_messages.append(message)
+        self._rows = None
+
+    def _flush(self):
+        if self._pending_rows:
+            rows, messages = self._pending_rows, self._pending_messages
+            self._pending_rows, self._pending_messages = [], []
+            self._append_block(None, rows, messages)
+
+    def get_blocks(self):
+        self._flush()
+        return self.blocks
+
+    def insert_blocks(self, position, blocks):
+        """Inserts `blocks`, e.g. found by a validation worker, before the block at `position`."""
+        self._flush()
+        self.blocks[position:position] = blocks
+        self._rows = None
+
+    def rows(self) -> numpy.ndarray:
+        """The sorted indexes of the flagged rows."""
+        if self._rows is None:
+            blocks = self.get_blocks()
+            self._rows = numpy.unique(numpy.concatenate([block.rows for block in blocks])) if blocks \
+                else numpy.array([], dtype="int64")
+        return self._rows
+
+    def __len__(self):
+        return len(self.rows())
+
+    def __bool__(self):
+        # answered without numpy, which an upload with no issues never needs to load
+        return bool(self.blocks or self._pending_rows)
+
+    def __iter__(self):
+        return iter(self.rows().tolist())
+
+    def __contains__(self, idx):
+        rows = self.rows()
+        position = numpy.searchsorted(rows, idx)
+        return bool(position < len(rows) and rows[position] == idx)
+
+    def __getitem__(self, idx):
+        messages = self.render(pandas.Index([idx]))
+        if not messages.iat[0]:
+            raise KeyError(idx)
+        return messages.iat[0].split("; ")
+
+    def get(self, idx, default=None):
+        return self[idx] if idx in self else default
+
+    def render(self, index: pandas.Index) -> pandas.Series:
+        """Builds the "; "-joined messages of each row of `index`, in the order they were found; "" if it has none."""
+        wanted = numpy.asarray(index)
+        if not len(wanted):
+            return pandas.Series("", index=index, dtype=object)
+        first, last = wanted.min(), wanted.max()
+        rows, order, messages = [], [], []
+        for position, block in enumerate(self.get_blocks()):
+            start = numpy.searchsorted(block.rows, first, side="left")
+            stop = numpy.searchsorted(block.rows, last, side="right")
+            if start >= stop:
+                continue
+            selected = numpy.zeros(len(block.rows), dtype=bool)
+            selected[start:stop] = numpy.isin(block.rows[start:stop], wanted)
+            if not selected.any():
+                continue
+            renderer = self.renderers.get(block.code)
+            values = block.values[selected]
+            if renderer is None:
+                rendered = values.tolist()
+            else:
+                details = block.details[selected] if block.details is not None else [True] * len(values)
+                rendered = [renderer(value, detail) for value, detail in zip(values, details)]
+            rows.append(block.rows[selected])
+            order.append(numpy.full(len(rendered), position))
+            messages.extend(rendered)
+        if not messages:
+            return pandas.Series("", index=index, dtype=object)
+        found = pandas.DataFrame({
+            "row": numpy.concatenate(rows), "order": numpy.concatenate(order), "message": messages
+        }).sort_values(["row", "order"], kind="stable")
+        joined = found.groupby("row", sort=False)["message"].agg("; ".join)
+        return joined.reindex(index, fill_value="")
+
+
 class UsersPreProcessor:
 
     @staticmethod
-    def __call__(users: pandas.DataFrame):
-        users["email"] = users["email"].apply(lambda x: x.lower())
+    def __call__(users):
+        users["email"] = engine_of(users).lower(users["email"])
         return users
 
 
@@ -127,28 +384,158 @@ class BaseUsersValidator:
     row_validators_prefix = "check_row_"
     username_field = "username"
     email_field = "email"
+    # run field validators column by column; set to False to validate one row at a time with validate_row
+    vectorized = True
+    # number of processes that run the field and check_row_ validators on shards of each chunk; the check_frame_
+    # validators always run in this process, as they need to see every row
+    workers = 1
+    # the check_frame_ validators whose results depend on the users already in the database, which are run again before
+    # a cached validation is reused
+    database_validators = ()
+    executor = None
 
-    def __init__(self, username_field=None, email_field=None, field_validator_cls=None, field_validator_overrides=None):
+    def __init__(self, username_field=None, email_field=None, field_validator_cls=None, field_validator_overrides=None,
+                 workers=None):
         self.field_validator_overrides = field_validator_overrides if field_validator_overrides \
             else self.field_validator_overrides
         self.field_validator = field_validator_cls(**self.field_validator_overrides) if field_validator_cls \
             else self.field_validator_cls(**self.field_validator_overrides)
         self.username_field = username_field if username_field else self.username_field
         self.email_field = email_field if email_field else self.email_field
+        self.workers = workers if workers else self.workers
 
     def __call__(self, users: pandas.DataFrame) -> validation_result_tuple:
+        return self.validate_each_chunk([users])
+
+    def reset(self):
+        """Clear any issues and cross-chunk state left over from a previous validation run."""
         self.issues = {
-            "errors": {},
-            "warnings": {},
+            "errors": IssueList(),
+            "warnings": IssueList(),
         }
-        users.apply(self.validate_row, axis=1)
-        for method in self.get_row_validators():
-            users.apply(method, axis=1)
-        for method in self.get_dataframe_validators():
-            method(users)
+        for key, validator in self.field_validator.items():
+            self.issues["errors"].renderers[key] = self.get_field_message_renderer(key, validator[1])
+        self.field_validator.memberships = MembershipTable()
 
+    def validate_chunks(self, chunks: Iterable[pandas.DataFrame]) -> validation_result_tuple:
+        """
+        Validates the users dataframe one chunk at a time. Chunks must keep the row index of the full upload, as
+        `pandas.read_csv(..., chunksize=...)` and the engines' `read_chunks` do, so that issues can be reported against
+        the original rows. A subclass that overrides `__call__` is called once with all the chunks joined, as it
+        expects the whole upload.
+        """
+        if type(self).__call__ is not BaseUsersValidator.__call__:
+            chunks = list(chunks)
+            if chunks:
+                return self(engine_of(chunks[0]).concat(chunks))
+        return self.validate_each_chunk(chunks)
+
+    def validate_each_chunk(self, chunks: Iterable[pandas.DataFrame]) -> validation_result_tuple:
+        """Runs the validators on one chunk at a time; see `validate_chunks`."""
+        self.reset()
+        with self.shard_executor() as executor:
+            self.executor = executor
+            try:
+                for users in chunks:
+                    self.validate_chunk(users)
+            finally:
+                self.executor = None
         return validation_result_tuple(self.issues["errors"], self.issues["warnings"])
 
+    def recheck_chunks(self, chunks: Iterable[pandas.DataFrame]) -> validation_result_tuple:
+        """
+        Runs only the `database_validators` on the users, one chunk at a time, to confirm that the cached validation of
+        an upload still holds for the database as it is now.
+        """
+        self.reset()
+        for users in chunks:
+            for method_name in self.database_validators:
+                with tracing.span(f"validation.{method_name}", len(users)):
+                    getattr(self, method_name)(users)
+        return validation_result_tuple(self.issues["errors"], self.issues["warnings"])
+
+    @contextmanager
+    def shard_executor(self):
+        """
+        Yields a pool of `workers` processes to validate shards in, or None to validate in this process. The workers
+        are forked so that they inherit this validator, whose field validators are often lambdas that cannot be
+        pickled. Where processes cannot be forked, or forking would be unsafe because other threads, e.g. those of a
+        threaded web server or of the run_in_thread job runner, may hold locks the workers would inherit, uploads are
+        validated in this process.
+        """
+        if self.workers <= 1:
+            yield None
+            return
+        if "fork" not in multiprocessing.get_all_start_methods():
+            logger.warning("Validating in a single process; parallel validation requires the fork start method.")
+            yield None
+            return
+        if threading.current_thread() is not threading.main_thread():
+            logger.warning("Validating in a single process; parallel validation is only forked from the main thread.")
+            yield None
+            return
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_shard_worker,
+            initargs=(self,),
+        ) as executor:
+            yield executor
+
+    @staticmethod
+    def get_field_message_renderer(key, message_builder):
+        """Builds the message of field `key` from an invalid value and the field validator's result for it."""
+        if message_builder:
+            return message_builder
+        return lambda value, invalid_info: f"{key}='{value}' is invalid."
+
+    def validate_chunk(self, users: pandas.DataFrame):
+        rows = len(users)
+        # where the blocks of this chunk start, so that the workers' blocks go before those of the frame validators
+        block_positions = {kind: len(issues.get_blocks()) for kind, issues in self.issues.items()}
+        if self.executor is None or not engine_of(users).fork_safe:
+            self.validate_shard(users)
+            shard_results = []
+        else:
+            shard_size = -(-rows // self.workers)
+            shard_results = [
+                self.executor.submit(_validate_shard, engine_of(users).slice(users, start, start + shard_size))
+                for start in range(0, rows, shard_size)
+            ]
+        # the frame validators run here while the shards are validated by the workers
+        for method in self.get_dataframe_validators():
+            with tracing.span(f"validation.{method.__name__}", rows):
+                method(users)
+        with tracing.span("validation.shards", rows):
+            for shard_result in shard_results:
+                block_positions = self.merge_shard(block_positions, *shard_result.result())
+
+    def validate_shard(self, users: pandas.DataFrame):
+        """Runs the field and check_row_ validators, which only look at one row at a time, on `users`."""
+        rows = len(users)
+        engine = engine_of(users)
+        with tracing.span("validation.fields", rows):
+            if self.vectorized:
+                self.validate_columns(users)
+            else:
+                engine.apply_rows(users, self.validate_row)
+        for method in self.get_row_validators():
+            with tracing.span(f"validation.{method.__name__}", rows):
+                engine.apply_rows(users, method)
+
+    def merge_shard(self, block_positions, issue_blocks, membership_tables):
+        """
+        Merges the issue blocks and memberships found by a worker into this validator's. The shard's field and row
+        issues go before those the frame validators found in the chunk, as they do when validating in one process.
+        Returns the positions at which to insert the blocks of the next shard.
+        """
+        for kind, blocks in issue_blocks.items():
+            self.issues[kind].insert_blocks(block_positions[kind], blocks)
+        memberships = self.field_validator.memberships
+        for column_name, tables in membership_tables.items():
+            memberships.tables.setdefault(column_name, []).extend(tables)
+        return {kind: position + len(issue_blocks.get(kind, [])) for kind, position in block_positions.items()}
+
     def get_dataframe_validators(self):
         methods = []
         for method_name in dir(self):
@@ -165,106 +552,638 @@ class BaseUsersValidator:
                 methods.append(maybe_method)
         return methods
 
+    def validate_columns(self, users: pandas.DataFrame):
+        """Runs every field validator against its whole column, building messages only for the rows that fail."""
+        engine = engine_of(users)
+        for key, validator in self.field_validator.items():
+            self.validate_column(key, engine.column(users, key), as_column_validator(validator))
+
+    def validate_column(self, key, column, validator: column_validator):
+        is_invalid, message_builder = validator
+        self.issues["errors"].add(key, *engine_of(column).flagged(column, is_invalid(column)))
+
     def validate_row(self, row):
-        for key, (is_invalid, message_builder) in self.field_validator.items():
+        for key, validator in self.field_validator.items():
+            if isinstance(validator, column_validator):
+                self.validate_column(key, engine_of(row).make_column([row.get(key, None)], [row.name]), validator)
+                continue
+            is_invalid, message_builder = validator
             value = row.get(key, None)
             invalid = is_invalid(value)
             if invalid:
-                message = f"{key}='{value}' is invalid." if not message_builder else message_builder(value, invalid)
-                append_or_create(self.issues["errors"], row.name, message)
+                self.issues["errors"].add(key, [row.name], [value], [invalid])
+
+
+# the validator that a forked validation worker validates shards with
+_shard_validator = None
+
+
+def _init_shard_worker(validator):
+    global _shard_validator
+    _shard_validator = validator
+    for connection in connections.all():
+        # the parent's database connections must not be used or closed by the fork; it opens its own if needed
+        connection.connection = None
+
+
+def _validate_shard(users):
+    validator = _shard_validator
+    validator.reset()
+    validator.validate_shard(users)
+    # renderers stay behind: they are often lambdas, and the parent's validator has the same ones
+    issue_blocks = {kind: issues.get_blocks() for kind, issues in validator.issues.items()}
+    return issue_blocks, validator.field_validator.memberships.tables
 
 
 class UsersValidator(BaseUsersValidator):
+    seen_values = None
+    # check the user model's unique fields and constraints whose columns are uploaded; see check_frame_unique_fields
+    check_unique_fields = True
+    database_validators = ("check_frame_unique_fields", "check_frame_username_collision")
+
+    def reset(self):
+        super().reset()
+        # column -> {value: [index of first row with value, whether that row was already reported]}
+        self.seen_values = {}
+
+    def record_duplicates(self, df, column):
+        """
+        Reports every row whose value in `column` also appears in another row, whether that row is in this chunk or
+        in a previously validated one. `column` may also be a tuple of columns, whose values are compared together.
+        """
+        seen = self.seen_values.setdefault(column, {})
+        engine = engine_of(df)
+        df = self.normalize_emails(df, column if isinstance(column, tuple) else (column,))
+        if isinstance(column, tuple):
+            values = engine.join(df, column, joined_values_separator)
+            renderer = self.get_unique_values_renderer(column, "row contains duplicate {}")
+            code = f"duplicate_{'_'.join(column)}"
+        else:
+            values = engine.column(df, column)
+            renderer = lambda value, detail: f"row contains duplicate {column}='{value}'"
+            code = f"duplicate_{column}"
+        rows, duplicate_values, _ = engine.flagged(values, engine.duplicated(values, seen))
+        # the first rows of values that were seen in earlier chunks, unless they were already reported
+        first_rows = []
+        first_values = []
+        for value in dict.fromkeys(value for value in duplicate_values if value in seen):
+            first = seen[value]
+            if not first[1]:
+                first_rows.append(first[0])
+                first_values.append(value)
+                first[1] = True
+        reported_rows, reported_values = rows, duplicate_values
+        if first_rows:
+            reported_rows = numpy.concatenate([
+                numpy.asarray(rows, dtype="int64"), numpy.asarray(first_rows, dtype="int64")
+            ])
+            reported_values = numpy.concatenate([
+                numpy.asarray(duplicate_values, dtype=object), numpy.asarray(first_values, dtype=object)
+            ])
+        self.issues["errors"].add(code, reported_rows, reported_values, renderer=renderer)
+        duplicated = set(duplicate_values)
+        for idx, value in zip(*engine.first_occurrences(values)):
+            if value not in seen:
+                seen[value] = [idx, value in duplicated]
+
+    def normalize_emails(self, df, columns):
+        """
+        The `columns` of `df`, with the emails lowercased as the users preprocessor stores them, so that emails that
+        only differ in case are compared as the same value.
+        """
+        if self.email_field not in columns or self.email_field not in df:
+            return df
+        engine = engine_of(df)
+        normalized = engine.select(df, columns).copy()
+        normalized[self.email_field] = engine.lower(normalized[self.email_field])
+        return normalized
 
     def check_frame_duplicates(self, df):
-        def record_duplicates(dup_row, column):
-            append_or_create(
-                self.issues["errors"],
-                dup_row.name,
-                f"row contains duplicate {column}='{dup_row[column]}'"
-            )
+        unique_field_sets = self.get_unique_field_sets(df.columns)
+        for column in (self.email_field, self.username_field):
+            # the duplicates of unique fields are recorded by check_frame_unique_fields
+            if (column,) not in unique_field_sets:
+                self.record_duplicates(df, column)
+
+    def get_unique_field_sets(self, columns) -> List[tuple]:
+        """
+        The columns of each of the user model's unique fields, unique constraints and unique_together sets that are all
+        among `columns`, in the model's order.
+        """
+        if not self.check_unique_fields:
+            return []
+        opts = User._meta
+        field_sets = [
+            (field.name,) for field in opts.concrete_fields if field.unique and not field.primary_key
+            and not field.is_relation
+        ]
+        field_sets.extend(tuple(fields) for fields in opts.unique_together)
+        field_sets.extend(
+            tuple(constraint.fields) for constraint in opts.constraints
+            if isinstance(constraint, UniqueConstraint) and constraint.fields and constraint.condition is None
+        )
+        unique_field_sets = []
+        for fields in field_sets:
+            if fields not in unique_field_sets and all(field in columns for field in fields):
+                unique_field_sets.append(fields)
+        return unique_field_sets
+
+    @staticmethod
+    def get_unique_values_renderer(fields, template):
+        if len(fields) == 1:
+            return lambda value, detail: template.format(f"{fields[0]}='{value}'")
+        return lambda value, detail: template.format(
+            ", ".join(f"{field}='{item}'" for field, item in zip(fields, value.split(joined_values_separator)))
+        )
 
-        df[df.duplicated(self.email_field, keep=False)].apply(lambda row: record_duplicates(row, self.email_field), axis=1)
-        df[df.duplicated(self.username_field, keep=False)].apply(lambda row: record_duplicates(row, self.username_field), axis=1)
+    def check_frame_unique_fields(self, df):
+        """
+        Reports, for each unique field or set of fields of the user model that is uploaded, the rows that share their
+        values with another row of the upload, and the rows whose values already belong to another user. Each field
+        set costs one batched lookup per chunk, of its first field's values; the rows are compared in memory.
+        """
+        engine = engine_of(df)
+        for fields in self.get_unique_field_sets(df.columns):
+            self.record_duplicates(df, fields if len(fields) > 1 else fields[0])
+            # a row with the username of an existing user is that user, so only other users' values conflict
+            if self.username_field in fields or self.username_field not in df:
+                continue
+            users = self.normalize_emails(df, [*fields, self.username_field])
+            first_column = engine.column(users, fields[0])
+            lookup_values = list(first_column)
+            if fields[0] == self.email_field:
+                # existing emails may also be stored as uploaded
+                lookup_values.extend(engine.column(df, fields[0]))
+            # the usernames of the existing users, by their values of `fields` as strings
+            owners = {}
+            for *values, username in load_existing_values(fields[0], lookup_values, [*fields, self.username_field]):
+                values = tuple(
+                    str(value).lower() if field == self.email_field else str(value)
+                    for field, value in zip(fields, values)
+                )
+                owners.setdefault(values, set()).add(str(username))
+            candidates = engine.mask(
+                engine.select(users, [*fields, self.username_field]),
+                engine.isin(first_column, {values[0] for values in owners}),
+            )
+            rows = []
+            conflicts = []
+            for row, user in zip(candidates.index, engine.records(candidates)):
+                values = tuple(str(user[field]) for field in fields)
+                # a row conflicts once, however many other users share its values
+                if owners.get(values, set()) - {str(user[self.username_field])}:
+                    rows.append(row)
+                    conflicts.append(joined_values_separator.join(values) if len(fields) > 1 else user[fields[0]])
+            self.issues["errors"].add(
+                f"existing_{'_'.join(fields)}",
+                rows,
+                conflicts,
+                renderer=self.get_unique_values_renderer(fields, "row contains {}, but another user already has it"),
+            )
 
     def check_frame_username_collision(self, df):
         """We want to error on any record where we already have the username but not the given email"""
+        engine = engine_of(df)
+        usernames = engine.column(df, self.username_field)
+        existing_emails = dict(
+            load_existing_values(self.username_field, usernames, [self.username_field, self.email_field])
+        )
+        candidates = engine.mask(
+            engine.select(df, [self.username_field, self.email_field]), engine.isin(usernames, existing_emails)
+        )
+        rows = []
+        collisions = []
+        for row, user in zip(candidates.index, engine.records(candidates)):
+            username = user[self.username_field]
+            # emails are compared case-insensitively
+            if str(user[self.email_field] or "").lower() != str(existing_emails[username] or "").lower():
+                rows.append(row)
+                collisions.append(username)
+        self.issues["errors"].add(
+            "username_collision",
+            rows,
+            collisions,
+            renderer=lambda username, detail: (
+                f"row contains username='{username}', but that user already exists with another email address"
+            ),
+        )
 
-        def record_collision(row):
-            append_or_create(
-                self.issues["errors"],
-                row.name,
-                f"row contains username='{row[self.username_field]}', but that user already exists with another email address",
-            )
 
-        q = Q(id=-1)
-        for user in df.to_dict("records"):
-            q |= Q(**{f"{self.username_field}": user[self.username_field]}) \
-                 & ~Q(**{f"{self.email_field}__iexact": user[self.email_field]})
-        existing_user_mapping = {
-            getattr(user, self.username_field): getattr(user, self.email_field) for user in User.objects.filter(q)
-        }
-        df[df[self.username_field].apply(lambda username: username in existing_user_mapping)].apply(record_collision, axis=1)
+creation_result_tuple = namedtuple("creation_result", ["created", "skipped", "updated"], defaults=[()])
+
+
+class CreationCheckpoint:
+    """
+    Remembers, in the Django cache, the index of the first row of an upload that has not been committed yet, so that a
+    batched creation that failed part way through can resume after its last committed batch.
+    """
+    key_prefix = "bulk_user_upload:checkpoint:"
+
+    def __init__(self, upload_key, timeout=None):
+        self.key = f"{self.key_prefix}{upload_key}"
+        self.timeout = timeout
+
+    def load(self) -> int:
+        return cache.get(self.key, 0)
+
+    def save(self, next_row: int):
+        cache.set(self.key, next_row, self.timeout)
+
+    def clear(self):
+        cache.delete(self.key)
 
 
-creation_result_tuple = namedtuple("creation_result", ["created", "skipped"])
+# the validation of an upload that passed all checks: its row count
+cached_validation_tuple = namedtuple("cached_validation", ["row_count"])
+
+
+class UploadCache:
+    """
+    Remembers, in the Django cache and by the upload's content hash, that an upload passed validation under the current
+    settings and groups and permissions, so that submitting a file that was just validated skips validating it again;
+    and the results of the last run that created users from it, so that submitting the same file again can be
+    recognized as a duplicate.
+    """
+    key_prefix = "bulk_user_upload:upload:"
+
+    def __init__(self, content_hash, timeout=None):
+        self.content_hash = content_hash
+        self.run_key = f"{self.key_prefix}{content_hash}:run"
+        self.timeout = timeout
+
+    @property
+    def validation_key(self):
+        return (
+            f"{self.key_prefix}{self.content_hash}:validation:{bulk_user_upload_settings.get_version()}:"
+            f"{get_lookup_version()}"
+        )
+
+    def load_validation(self) -> cached_validation_tuple:
+        validation = cache.get(self.validation_key)
+        return None if validation is None else cached_validation_tuple(*validation)
+
+    def save_validation(self, validation: cached_validation_tuple):
+        # stored as a plain tuple, which unlike the namedtuple can be pickled
+        cache.set(self.validation_key, tuple(validation), self.timeout)
+
+    def load_run(self) -> dict:
+        """The results of the last completed run, with the time it finished as `finished_at`, or None."""
+        return cache.get(self.run_key)
+
+    def save_run(self, created=0, updated=0):
+        run = dict(created=created, updated=updated, finished_at=timezone.now())
+        cache.set(self.run_key, run, self.timeout)
 
 
 class BaseUsersCreator:
     username_field = "username"
     users_preprocessor_cls = UsersPreProcessor
+    bulk_create_batch_size = 1000
+    batch_size = None
+    # update existing users whose uploaded row differs from them, instead of skipping them
+    upsert = False
+    # the membership table filled in while the upload was validated, if any, which saves parsing the permissions and
+    # groups columns again
+    memberships = None
 
     def preprocess_users(self, users):
         return self.users_preprocessor_cls()(users)
 
-    def __init__(self, username_field=None, users_preprocessor_cls=None):
+    def __init__(self, username_field=None, users_preprocessor_cls=None, batch_size=None, upsert=None):
         self.username_field = username_field if username_field else self.username_field
         self.users_preprocessor_cls = users_preprocessor_cls if users_preprocessor_cls else self.users_preprocessor_cls
+        self.batch_size = batch_size if batch_size else self.batch_size
+        self.upsert = upsert if upsert is not None else self.upsert
 
-    def __call__(self, users: pandas.DataFrame) -> creation_result_tuple:
-        username_field = self.username_field
-        users = self.preprocess_users(users)
-        user_records = users.to_dict("records")
+    def create_in_batches(self, chunks: Iterable[pandas.DataFrame], checkpoint: CreationCheckpoint = None):
+        """
+        Creates the users `batch_size` rows at a time (or a chunk at a time if `batch_size` is not set), committing each
+        batch in its own transaction and yielding its creation result. Batches span chunks, so a `batch_size` larger
+        than the chunks is kept. After each commit the checkpoint is moved past the batch; batches before the saved
+        checkpoint are skipped, so a failed run picks up where it left off. Each batch is created by calling the
+        creator, so subclasses that override `__call__` are used for every batch.
+        """
+        resume_from = checkpoint.load() if checkpoint else 0
+        pending = None
+        for users in chunks:
+            engine = engine_of(users)
+            # the rows left over from the previous chunk go first
+            pending = users if pending is None else engine.concat([pending, users])
+            batch_size = self.batch_size or len(pending)
+            while len(pending) and len(pending) >= batch_size:
+                batch = engine.slice(pending, 0, batch_size).copy()
+                pending = engine.slice(pending, batch_size, len(pending))
+                if batch.index[-1] >= resume_from:
+                    yield self.create_batch(batch, checkpoint)
+        if pending is not None and len(pending) and pending.index[-1] >= resume_from:
+            yield self.create_batch(pending.copy(), checkpoint)
+
+    def create_batch(self, batch, checkpoint=None):
+        """Creates the users of `batch` in their own transaction, then moves the checkpoint past it."""
+        with transaction.atomic():
+            result = self(batch)
+        if checkpoint:
+            checkpoint.save(batch.index[-1] + 1)
+        return result
+
+    @staticmethod
+    def get_through(relation_name):
+        """Returns the through model of a User many-to-many relation, and the names of its user and target fields."""
+        relation = User._meta.get_field(relation_name)
+        through = relation.remote_field.through
+        return through, relation.m2m_field_name(), relation.m2m_reverse_field_name()
+
+    def assign_access(self, users, user_access_map, access_key, relation_name):
+        """
+        Adds each new user to the groups or permissions listed under `access_key` in `user_access_map`, inserting the
+        rows of the `relation_name` many-to-many through table with a single chunked bulk_create.
+        """
+        through, user_field_name, target_field_name = self.get_through(relation_name)
+        user_attname = through._meta.get_field(user_field_name).attname
+        target_attname = through._meta.get_field(target_field_name).attname
+        through.objects.bulk_create(
+            [
+                through(**{user_attname: user.pk, target_attname: target_id})
+                for user in users
+                for target_id in dict.fromkeys(user_access_map[getattr(user, self.username_field)][access_key])
+            ],
+            batch_size=self.bulk_create_batch_size,
+        )
+
+    def sync_access(self, users, user_access_map, access_key, relation_name):
+        """
+        Adds and removes `relation_name` memberships of existing users so that they match the groups or permissions
+        listed under `access_key` in `user_access_map`. Returns the primary keys of the users whose memberships changed.
+        """
+        through, user_field_name, target_field_name = self.get_through(relation_name)
+        user_attname = through._meta.get_field(user_field_name).attname
+        target_attname = through._meta.get_field(target_field_name).attname
+        current = {}
+        for pk, user_id, target_id in filter_in_chunks(
+            through.objects.values_list("pk", user_attname, target_attname), user_field_name, [user.pk for user in users]
+        ):
+            current.setdefault(user_id, {})[target_id] = pk
+
+        to_add = []
+        to_remove = []
+        changed = set()
+        for user in users:
+            desired = set(user_access_map[getattr(user, self.username_field)][access_key])
+            memberships = current.get(user.pk, {})
+            to_add.extend(
+                through(**{user_attname: user.pk, target_attname: target_id}) for target_id in desired - memberships.keys()
+            )
+            to_remove.extend(memberships[target_id] for target_id in memberships.keys() - desired)
+            if desired != memberships.keys():
+                changed.add(user.pk)
 
-        groups_map = get_groups_map()
-        perms_map = get_perms_map()
-        user_access_map = {}
+        for start in range(0, len(to_remove), self.bulk_create_batch_size):
+            through.objects.filter(pk__in=to_remove[start:start + self.bulk_create_batch_size]).delete()
+        through.objects.bulk_create(to_add, batch_size=self.bulk_create_batch_size)
+        return changed
+
+    def update_existing(self, existing_users, user_records):
+        """
+        Updates the fields of existing users that differ from their uploaded row, running one chunked bulk_update per
+        distinct set of changed fields. Returns the primary keys of the users that changed.
+        """
+        users_by_changed_fields = {}
         for user_record in user_records:
-            perms = [perms_map[p.strip()] for p in user_record.pop("permissions", "").split(",") if p]
-            groups = [groups_map[g.strip()] for g in user_record.pop("groups", "").split(",") if g]
-            user_access_map[user_record[username_field]] = dict(perms=perms, groups=groups)
+            user = existing_users[user_record[self.username_field]]
+            changed_fields = []
+            for name, value in user_record.items():
+                field = User._meta.get_field(name)
+                if field.primary_key or name == self.username_field:
+                    continue
+                value = field.to_python(value)
+                if getattr(user, field.attname) != value:
+                    setattr(user, field.attname, value)
+                    changed_fields.append(name)
+            if changed_fields:
+                users_by_changed_fields.setdefault(tuple(changed_fields), []).append(user)
 
-        existing_users = {
-            getattr(u, username_field): u for u in User.objects.filter(**{f"{username_field}__in": [*user_access_map]})
-        }
+        for changed_fields, users in users_by_changed_fields.items():
+            User.objects.bulk_update(users, changed_fields, batch_size=self.bulk_create_batch_size)
+        return {user.pk for users in users_by_changed_fields.values() for user in users}
+
+    def get_access_by_row(self, users, memberships=None):
+        """
+        Maps each access key to the ids listed for it by row of `users`, e.g. {"perms": {3: [1, 2]}, "groups": {}},
+        reusing the membership table filled in during validation and parsing any list column it does not cover.
+        """
+        access_by_row = {}
+        for access_key, column_name, get_lookup_map in (
+                ("perms", "permissions", get_perms_map), ("groups", "groups", get_groups_map)
+        ):
+            table = memberships
+            if column_name in users and (table is None or column_name not in table):
+                table = MembershipTable()
+                table.add(column_name, users[column_name], get_lookup_map())
+            access_by_row[access_key] = table.ids_by_row(column_name, users.index) if table is not None else {}
+        return access_by_row
+
+    def __call__(self, users: pandas.DataFrame) -> creation_result_tuple:
+        username_field = self.username_field
+        engine = engine_of(users)
+        with tracing.span("creation.preprocess", len(users)):
+            users = self.preprocess_users(users)
+        with tracing.span("creation.memberships", len(users)):
+            access_by_row = self.get_access_by_row(users, self.memberships)
+            user_records = engine.records(
+                engine.select(users, [column for column in users.columns if column not in ("permissions", "groups")])
+            )
+            user_access_map = {
+                username: {access_key: ids.get(row, []) for access_key, ids in access_by_row.items()}
+                for row, username in zip(users.index, users[username_field])
+            }
+
+        with tracing.span("creation.existing_users", len(users)):
+            existing_users = {
+                getattr(u, username_field): u
+                for u in filter_in_chunks(User.objects.all(), username_field, [*user_access_map])
+            }
 
         to_create, skipped = partition(lambda user: user[username_field] in existing_users, user_records)
 
-        results = User.objects.bulk_create([
-            User(**dict(**user, password="no-login")) for user in to_create
-        ], ignore_conflicts=False)
+        with tracing.span("creation.insert", len(to_create)):
+            results = User.objects.bulk_create([
+                User(**dict(**user, password="no-login")) for user in to_create
+            ], ignore_conflicts=False, batch_size=self.bulk_create_batch_size)
 
-        results_with_ids = User.objects.filter(**{f"{username_field}__in": [getattr(u, username_field) for u in results]})
-        for user in results_with_ids:
-            if user_access_map[getattr(user, username_field)]["perms"]:
-                user.user_permissions.set(user_access_map[getattr(user, username_field)]["perms"])
-            if user_access_map[getattr(user, username_field)]["groups"]:
-                user.groups.set(user_access_map[getattr(user, username_field)]["groups"])
+            if all(user.pk is not None for user in results):
+                # the backend returned the primary keys of the inserted rows
+                results_with_ids = results
+            else:
+                results_with_ids = list(
+                    filter_in_chunks(User.objects.all(), username_field, [getattr(u, username_field) for u in results])
+                )
+        with tracing.span("creation.assign_access", len(results_with_ids)):
+            self.assign_access(results_with_ids, user_access_map, "perms", "user_permissions")
+            self.assign_access(results_with_ids, user_access_map, "groups", "groups")
 
-        return creation_result_tuple(results_with_ids, [existing_users[u[username_field]] for u in skipped])
+        skipped_users = [existing_users[u[username_field]] for u in skipped]
+        if not self.upsert or not skipped_users:
+            return creation_result_tuple(results_with_ids, skipped_users)
+
+        with tracing.span("creation.update", len(skipped_users)):
+            changed = self.update_existing(existing_users, skipped)
+            if "permissions" in users:
+                changed |= self.sync_access(skipped_users, user_access_map, "perms", "user_permissions")
+            if "groups" in users:
+                changed |= self.sync_access(skipped_users, user_access_map, "groups", "groups")
+        return creation_result_tuple(
+            results_with_ids,
+            [user for user in skipped_users if user.pk not in changed],
+            [user for user in skipped_users if user.pk in changed],
+        )
 
 
 def get_email_recipient_name(user: User):
     return f"{user.first_name} {user.last_name}" if user.first_name and user.last_name else user.email
 
 
+# template name -> (template, path of the template file, modification time of the file when it was compiled)
+_compiled_templates = {}
+
+
+def _modification_time(path):
+    try:
+        return os.path.getmtime(path)
+    except (OSError, TypeError, ValueError):
+        return None
+
+
+def _reset_template_loaders():
+    """Empties the caches of Django's cached template loaders, so that changed template files are loaded again."""
+    for backend in engines.all():
+        if isinstance(backend, DjangoTemplates):
+            for loader in backend.engine.template_loaders:
+                if hasattr(loader, "reset"):
+                    loader.reset()
+
+
+def get_compiled_template(template_name):
+    """
+    Returns the compiled template for `template_name`, compiling it only once across uploads. Templates loaded from a
+    file are recompiled when the file changes, after the cached template loaders are reset; other templates are not
+    cached.
+    """
+    cached = _compiled_templates.get(template_name)
+    if cached is not None:
+        template, path, compiled_mtime = cached
+        if _modification_time(path) == compiled_mtime:
+            return template
+        _reset_template_loaders()
+    template = get_template(template_name)
+    path = getattr(getattr(template, "origin", None), "name", None)
+    mtime = _modification_time(path)
+    if mtime is not None:
+        _compiled_templates[template_name] = (template, path, mtime)
+    else:
+        _compiled_templates.pop(template_name, None)
+    return template
+
+
+def clear_compiled_templates(*args, **kwargs):
+    if kwargs.get("setting", "TEMPLATES") == "TEMPLATES":
+        _compiled_templates.clear()
+
+
+setting_changed.connect(clear_compiled_templates)
+
+email_result_tuple = namedtuple("email_result", ["sent", "failed", "seconds"])
+
+
+class RateLimiter:
+    """Spaces out calls to `wait`, across threads, so that at most `rate` calls proceed per second."""
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
 class EmailSender:
+    """
+    Sends account creation emails over a pool of `concurrency` reused email backend connections, at most `rate_limit`
+    messages per second. A message that fails to send is logged and counted rather than aborting the rest.
+    """
     username_field = "username"
     email_field = "email"
+    concurrency = 1
+    rate_limit = None
 
-    def __init__(self, username_field=None, email_field=None):
+    def __init__(self, username_field=None, email_field=None, concurrency=None, rate_limit=None):
         self.username_field = username_field if username_field else self.username_field
         self.email_field = email_field if email_field else self.email_field
+        self.concurrency = concurrency if concurrency else self.concurrency
+        self.rate_limit = rate_limit if rate_limit else self.rate_limit
+
+    @staticmethod
+    def get_renderer(template_name):
+        """
+        Returns a function rendering the compiled `template_name` with a dict of context values. For Django templates a
+        single Context is reused for every render, with each user's values pushed onto and popped off of it.
+        """
+        template = get_compiled_template(template_name)
+        engine_template = getattr(template, "template", None)
+        if not isinstance(engine_template, Template):
+            return template.render
+        context = Context(autoescape=template.backend.engine.autoescape)
+
+        def render(values):
+            with context.push(values):
+                return engine_template.render(context)
+        return render
+
+    def build_messages(self, template_name, login_url, from_email, subject, get_recipient_name, new_users):
+        render = self.get_renderer(template_name)
+        return [
+            EmailMessage(
+                subject,
+                render(
+                    dict(
+                        login_url=login_url,
+                        username=getattr(user, self.username_field),
+                        recipient_name=get_recipient_name(user)
+                    )
+                ),
+                from_email,
+                [getattr(user, self.email_field)],
+            )
+            for user in new_users
+        ]
+
+    @staticmethod
+    def send_over_connection(messages: List[EmailMessage], rate_limiter: RateLimiter):
+        """Sends `messages` one by one over a single backend connection; returns the number of messages sent."""
+        sent = 0
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception as e:  # noqa
+            logger.exception(f"Could not open a connection to send account creation emails: {e}", exc_info=e)
+            return sent
+        try:
+            for message in messages:
+                rate_limiter.wait()
+                try:
+                    sent += connection.send_messages([message]) or 0
+                except Exception as e:  # noqa
+                    logger.exception(f"Could not send account creation email to {message.to}: {e}", exc_info=e)
+        finally:
+            connection.close()
+        return sent
 
     def __call__(
         self,
@@ -274,22 +1193,95 @@ class EmailSender:
         subject: str,
         get_recipient_name,
         new_users: List[User]
-    ):
-        send_mass_mail(
-            [
-                (
-                    subject,
-                    render_to_string(
-                        template_name=template_name,
-                        context=dict(
-                            login_url=login_url,
-                            username=getattr(user, self.username_field),
-                            recipient_name=get_recipient_name(user)
+    ) -> email_result_tuple:
+        started = time.monotonic()
+        with tracing.span("emails.render", len(new_users)):
+            messages = self.build_messages(template_name, login_url, from_email, subject, get_recipient_name, new_users)
+        rate_limiter = RateLimiter(self.rate_limit)
+        concurrency = max(1, min(self.concurrency, len(messages)))
+        with tracing.span("emails.send", len(messages)):
+            if concurrency == 1:
+                sent = self.send_over_connection(messages, rate_limiter)
+            else:
+                with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                    sent = sum(
+                        executor.map(
+                            lambda share: self.send_over_connection(share, rate_limiter),
+                            [messages[i::concurrency] for i in range(concurrency)],
                         )
-                    ),
-                    from_email,
-                    [getattr(user, self.email_field)],
-                )
-                for user in new_users
-            ]
-        )
+                    )
+        return email_result_tuple(sent, len(messages) - sent, time.monotonic() - started)
+
+
+def get_accepted_options(cls, **options) -> dict:
+    """The `options` that the constructor of `cls` accepts as keyword arguments."""
+    parameters = inspect.signature(cls).parameters
+    accepts_any = any(parameter.kind == parameter.VAR_KEYWORD for parameter in parameters.values())
+    return {name: value for name, value in options.items() if accepts_any or name in parameters}
+
+
+def construct_with_options(cls, options, **kwargs):
+    """
+    Instantiates `cls` with `kwargs`, passing it `options` only if its constructor accepts them, so that subclasses
+    written for an older constructor keep working; the options it doesn't accept are set on the instance instead.
+    """
+    accepted = get_accepted_options(cls, **options)
+    instance = cls(**kwargs, **accepted)
+    for name, value in options.items():
+        if name not in accepted and value is not None:
+            setattr(instance, name, value)
+    return instance
+
+
+def get_users_validator(
+        users_validator_cls, username_field, email_field, field_validator_cls=None, field_validator_overrides=None,
+        workers=None
+):
+    """Instantiates a USERS_VALIDATOR class; see `construct_with_options`."""
+    return construct_with_options(
+        users_validator_cls,
+        dict(workers=workers),
+        username_field=username_field,
+        email_field=email_field,
+        field_validator_cls=field_validator_cls,
+        field_validator_overrides=field_validator_overrides,
+    )
+
+
+def get_users_creator(users_creator_cls, username_field, users_preprocessor_cls, batch_size=None, upsert=None):
+    """Instantiates a USERS_CREATOR class; see `construct_with_options`."""
+    return construct_with_options(
+        users_creator_cls,
+        dict(batch_size=batch_size, upsert=upsert),
+        username_field=username_field,
+        users_preprocessor_cls=users_preprocessor_cls,
+    )
+
+
+def get_email_sender(email_sender_cls, username_field, email_field, concurrency=None, rate_limit=None):
+    """
+    Instantiates an EMAIL_SENDER class, passing it `concurrency` and `rate_limit` only if its constructor accepts them,
+    so that senders written for the original `(username_field, email_field)` constructor keep working.
+    """
+    options = get_accepted_options(email_sender_cls, concurrency=concurrency, rate_limit=rate_limit)
+    return email_sender_cls(username_field=username_field, email_field=email_field, **options)
+
+
+def send_account_emails(
+    email_sender,
+    template_name: str,
+    login_url: str,
+    from_email: str,
+    subject: str,
+    get_recipient_name,
+    new_users: List[User]
+) -> email_result_tuple:
+    """
+    Sends the account creation emails of `new_users` with `email_sender` and returns its result. Senders that return
+    None, as they did before results were reported, raise when sending fails, so all of their emails count as sent.
+    """
+    started = time.monotonic()
+    result = email_sender(template_name, login_url, from_email, subject, get_recipient_name, new_users)
+    if result is None:
+        return email_result_tuple(len(new_users), 0, time.monotonic() - started)
+    return result
@@ -65,7 +65,8 @@ BULK_USER_UPLOAD = dict(
         )
     ),
     GET_EMAIL_RECIPIENT_NAME=lambda user: user.name,
-    USERS_VALIDATOR='users.bulk_user_upload_customizations.CustomUsersValidator'
+    USERS_VALIDATOR='users.bulk_user_upload_customizations.CustomUsersValidator',
+    UPLOAD_ENGINE='auto',
 )
 
 MIDDLEWARE = [
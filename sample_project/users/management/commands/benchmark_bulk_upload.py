@@ -0,0 +1,252 @@
+import csv
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+from contextlib import ExitStack
+from datetime import datetime, timezone
+
+import django
+import pandas
+from django.contrib.auth.models import Group
+from django.core import mail
+from django.core.files.uploadedfile import UploadedFile
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import override_settings
+
+from bulk_user_upload.admin import BulkUploadUsers
+from bulk_user_upload.engines import engines
+from bulk_user_upload.settings import bulk_user_upload_settings
+from bulk_user_upload.tracing import QueryCounter
+
+HEADERS = ["username", "email", "name", "is_staff", "groups", "permissions"]
+GROUP_LISTS = ["", "Staff", "Staff,Other"]
+PERMISSION_LISTS = ["", "users.add_user", "users.add_user,users.change_user"]
+
+
+def write_users_csv(path, rows, invalid_share=0.0, duplicate_share=0.0, seed=0):
+    """
+    Writes `rows` synthetic users to `path`. About `invalid_share` of the rows have an invalid email, group or name,
+    and about `duplicate_share` of them repeat the username and email of an earlier row.
+    """
+    rng = random.Random(seed)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADERS)
+        for i in range(rows):
+            row = [f"bench_{i}", f"bench_{i}@example.com", f"Bench User {i}", i % 2,
+                   rng.choice(GROUP_LISTS), rng.choice(PERMISSION_LISTS)]
+            draw = rng.random()
+            if draw < invalid_share:
+                if i % 3 == 0:
+                    row[1] = "not-an-email"
+                elif i % 3 == 1:
+                    row[4] = "Not A Group"
+                else:
+                    row[2] = ""
+            elif draw < invalid_share + duplicate_share and i:
+                original = rng.randrange(i)
+                row[0], row[1] = f"bench_{original}", f"bench_{original}@example.com"
+            writer.writerow(row)
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks each stage of the bulk user upload pipeline (parse, preprocess, validation, creation and emails) "
+        "on synthetic CSVs, against a throwaway test database and the locmem email backend, and writes the timings, "
+        "query counts and peak memory as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows", type=int, nargs="+", default=[1000, 10000, 100000, 1000000],
+            help="Upload sizes to benchmark (default: 1000 10000 100000 1000000).",
+        )
+        parser.add_argument(
+            "--invalid-share", type=float, default=0.01,
+            help="Share of rows with an invalid field in the file that is validated (default: 0.01).",
+        )
+        parser.add_argument(
+            "--duplicate-share", type=float, default=0.01,
+            help="Share of rows that duplicate an earlier row in the file that is validated (default: 0.01).",
+        )
+        parser.add_argument(
+            "--engine", choices=["auto", *engines],
+            help="Engine the uploads are processed with (default: UPLOAD_ENGINE).",
+        )
+        parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic data (default: 0).")
+        parser.add_argument("--skip-emails", action="store_true", help="Do not benchmark sending the emails.")
+        parser.add_argument(
+            "--no-memory", action="store_true",
+            help="Do not trace peak memory, which slows down every stage, so that the timings are undisturbed.",
+        )
+        parser.add_argument("--output", help="Write the JSON results to this file instead of stdout.")
+
+    def handle(self, *args, rows=(), invalid_share=0.01, duplicate_share=0.01, engine=None, seed=0, skip_emails=False,
+               no_memory=False, output=None, **options):
+        self.trace_memory = not no_memory
+        if self.trace_memory and not hasattr(tracemalloc, "reset_peak"):
+            # the peak of each stage is only measured from scratch on Python 3.9 or later
+            self.stderr.write("Peak memory is not traced before Python 3.9; pass --no-memory to hide this warning.")
+            self.trace_memory = False
+        self.engine_name = engine
+        results = dict(
+            started_at=datetime.now(timezone.utc).isoformat(),
+            environment=dict(
+                python=platform.python_version(),
+                django=django.get_version(),
+                pandas=pandas.__version__,
+                database=connection.vendor,
+                upload_engine=engine or bulk_user_upload_settings.UPLOAD_ENGINE,
+                upload_chunk_size=bulk_user_upload_settings.UPLOAD_CHUNK_SIZE,
+                creation_batch_size=bulk_user_upload_settings.CREATION_BATCH_SIZE,
+            ),
+            invalid_share=invalid_share,
+            duplicate_share=duplicate_share,
+            runs=[],
+        )
+        if self.trace_memory:
+            tracemalloc.start()
+        try:
+            with tempfile.TemporaryDirectory() as temp_dir, override_settings(
+                EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"
+            ):
+                for size in rows:
+                    dirty_path = os.path.join(temp_dir, f"users_{size}.csv")
+                    clean_path = os.path.join(temp_dir, f"users_{size}_clean.csv")
+                    write_users_csv(dirty_path, size, invalid_share, duplicate_share, seed)
+                    write_users_csv(clean_path, size, seed=seed)
+                    self.stderr.write(f"Benchmarking {size} rows...")
+                    results["runs"].append(self.run_in_test_database(size, dirty_path, clean_path, skip_emails))
+        finally:
+            if self.trace_memory:
+                tracemalloc.stop()
+
+        report = json.dumps(results, indent=2)
+        if output:
+            with open(output, "w") as f:
+                f.write(report)
+        else:
+            self.stdout.write(report)
+
+    def run_in_test_database(self, size, dirty_path, clean_path, skip_emails):
+        """Runs the benchmark for one upload size against a freshly migrated test database."""
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            for name in ("Staff", "Other"):
+                Group.objects.get_or_create(name=name)
+            # the uploads opened by get_form are closed once all stages have run
+            with ExitStack() as upload_files:
+                self.upload_files = upload_files
+                return dict(rows=size, stages=self.run_stages(dirty_path, clean_path, skip_emails))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def measure(self, stages, name, function):
+        """
+        Runs `function` and records its duration, query count and peak traced memory under `name` in `stages`,
+        along with the stage details it returns. Returns the stage's result, or None if it failed.
+        """
+        counter = QueryCounter()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        result = None
+        stage = {}
+        try:
+            with connection.execute_wrapper(counter):
+                result, details = function()
+            stage.update(details)
+        except Exception as e:
+            stage["error"] = f"{type(e).__name__}: {e}"
+        stage["seconds"] = round(time.perf_counter() - started, 4)
+        stage["queries"] = counter.count
+        if self.trace_memory:
+            stage["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1] - baseline
+        stages[name] = stage
+        self.stderr.write(f"  {name}: {stage}")
+        return result
+
+    def get_form(self, path):
+        upload = UploadedFile(
+            file=self.upload_files.enter_context(open(path, "rb")), name=os.path.basename(path), content_type="text/csv", size=os.path.getsize(path)
+        )
+        form = bulk_user_upload_settings.USER_UPLOAD_FORM(data={"send_emails": True}, files={"csv_file": upload})
+        # every stage is measured from scratch
+        form.use_upload_cache = False
+        form.engine_name = self.engine_name
+        return form
+
+    def run_stages(self, dirty_path, clean_path, skip_emails):
+        view = BulkUploadUsers()
+        stages = {}
+
+        def parse():
+            form = self.get_form(dirty_path)
+            chunks = list(form.read_uploaded_chunks(form.files["csv_file"]))
+            return chunks, dict(rows=sum(len(chunk) for chunk in chunks))
+
+        chunks = self.measure(stages, "parse", parse)
+
+        def preprocess():
+            preprocessor = view.users_preprocessor_cls()
+            for chunk in chunks:
+                preprocessor(chunk.copy())
+            return None, dict(rows=sum(len(chunk) for chunk in chunks))
+
+        if chunks is not None:
+            self.measure(stages, "preprocess", preprocess)
+        del chunks
+
+        def validate(path):
+            def run():
+                form = self.get_form(path)
+                is_valid = form.is_valid()
+                issues = form.uploaded_data
+                return form, dict(
+                    rows=form.row_count,
+                    valid=is_valid,
+                    errors=int((issues["errors"] != "").sum()) if "errors" in issues else 0,
+                    warnings=int((issues["warnings"] != "").sum()) if "warnings" in issues else 0,
+                )
+            return run
+
+        self.measure(stages, "validation", validate(dirty_path))
+        form = self.measure(stages, "validation_clean", validate(clean_path))
+        if form is None or not form.is_valid():
+            return stages
+
+        def create():
+            users_creator = view.users_creator
+            users_creator.memberships = form.memberships
+            created = []
+            with transaction.atomic():
+                for result in users_creator.create_in_batches(form.iter_uploaded_chunks()):
+                    created.extend(result.created)
+            return created, dict(rows=len(created))
+
+        created = self.measure(stages, "creation", create)
+        if skip_emails or not created:
+            return stages
+
+        def send_emails():
+            mail.outbox = []
+            result = view.email_sender(
+                view.email_template_name,
+                "http://testserver/",
+                view.email_sender_address,
+                view.email_subject,
+                view.get_email_recipient_name,
+                created,
+            )
+            mail.outbox = []
+            return result, dict(rows=len(created), sent=result.sent, failed=result.failed)
+
+        self.measure(stages, "emails", send_emails)
+        return stages
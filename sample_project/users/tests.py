@@ -0,0 +1,37 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from django.test import SimpleTestCase
+
+# run in a fresh process, as the test runner itself may already have loaded pandas
+STARTUP_SCRIPT = """
+import json
+import sys
+
+import django
+from django.core.management import call_command
+
+django.setup()
+call_command("check")
+print(json.dumps({name: name in sys.modules for name in ("pandas", "numpy")}))
+"""
+
+
+class StartupImportsTests(SimpleTestCase):
+
+    def test_startup_does_not_load_pandas_or_numpy(self):
+        """Setting up Django and running the system checks, which import the admin, must not load pandas or numpy."""
+        project_dir = Path(__file__).resolve().parent.parent
+        result = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT],
+            cwd=project_dir,
+            env=dict(os.environ, DJANGO_SETTINGS_MODULE="sample_project.settings"),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        loaded = json.loads(result.stdout.strip().splitlines()[-1])
+        self.assertEqual(loaded, {"pandas": False, "numpy": False})